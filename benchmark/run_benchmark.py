@@ -0,0 +1,353 @@
+# Benchmarks cache.py against the local stand-in of the site (standin.py), so changes can be timed without the real
+# Wordpress site. It times:
+#   cold:    a download into an empty folder
+#   warm:    a download right after that, with nothing changed
+#   page:    a download after one page was edited
+#   navbar:  a download after the navbar (on every page) was changed
+#   links:   finding and substituting the links of all html pages in memory (FindNewRoutes/SubstituteRoutes and ScanRoutes)
+#
+# ScanRoutes is also compared with FindNewRoutes/SubstituteRoutes on documents made of random links of the pages, in
+# which a substitution can make a later pattern match across other links. golden.json has the number of those that
+# differ, which may not grow
+#
+# The output is compared with golden.json, and the warm downloads with a cold download of the same edits, so a
+# performance change can't silently change the mirror. After an intended change of the output: --update-golden
+#
+# Usage: python benchmark/run_benchmark.py [--concurrency 8] [--repeat 3] [--json results.json]
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+
+BENCHMARK_DIR = Path(__file__).parent
+CACHE_PY = BENCHMARK_DIR.parent / "cache.py"
+GOLDEN_FILE = BENCHMARK_DIR / "golden.json"
+# Written next to the mirror by cache.py, with the times of the download in them
+METADATA_FILES = {".manifest.jsonl", ".modification-times.json", ".changes.json"}
+EDITED_PAGE = "/committees"
+FUZZ_DOCUMENTS = 20000
+# Put between the links in the fuzzed documents, so the patterns can match across links
+FUZZ_GLUE = [" ", "\n", ">", '"', "'", ")", "url(", '<link rel="icon" ', 'srcset="']
+SCENARIOS = ["cold", "warm", "page", "navbar"]
+
+sys.path.insert(0, str(BENCHMARK_DIR))
+import standin
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--concurrency", help="Passed on to cache.py", type=int, default=8)
+parser.add_argument(
+    "--repeat", help="Number of times every benchmark is run", type=int, default=1
+)
+parser.add_argument("--json", help="Also write the results to this file")
+parser.add_argument(
+    "--update-golden",
+    help="Write the output of this version to golden.json instead of comparing with it",
+    action="store_true",
+)
+parser.add_argument(
+    "--skip-crawl", help="Only run the links benchmark", action="store_true"
+)
+args = parser.parse_args()
+
+
+def HashFile(location):
+    with open(location, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# The sha256 of every file in the mirror, apart from the metadata of cache.py
+def HashMirror(directory):
+    hashes = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = Path(root, name).relative_to(directory).as_posix()
+            if path not in METADATA_FILES:
+                hashes[path] = HashFile(Path(root, name))
+    return dict(sorted(hashes.items()))
+
+
+def CompareMirrors(expected, actual, description):
+    differences = sorted(
+        path
+        for path in expected.keys() | actual.keys()
+        if expected.get(path) != actual.get(path)
+    )
+    if len(differences) != 0:
+        print(f"FATAL ERROR: {description} differs in {len(differences)} files:")
+        for path in differences[:20]:
+            print(f"    {path}")
+        exit(-1)
+
+
+class StandIn:
+    def __init__(self, directory):
+        self.state = Path(directory) / "state.json"
+        self.SetState({})
+        self.process = subprocess.Popen(
+            [sys.executable, BENCHMARK_DIR / "standin.py", "--port", "0"]
+            + ["--state", self.state],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.url = self.process.stdout.readline().split()[-1]
+
+    def SetState(self, state):
+        with open(self.state, "w") as f:
+            json.dump(state, f)
+
+    def Stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+# Returned: (seconds, downloaded, not modified)
+def RunCache(standIn, directory):
+    env = dict(os.environ)
+    env["WEBSITE_URL"] = standIn.url
+    env["EVENTS_API_URL"] = standIn.url + "/v2/events"
+    env["AUTH_BASIC_USER"] = standin.USER
+    env["AUTH_BASIC_PASSWORD"] = standin.PASSWORD
+    command = [sys.executable, CACHE_PY, "--concurrency", str(args.concurrency)]
+    start = perf_counter()
+    result = subprocess.run(
+        command, cwd=directory, env=env, capture_output=True, text=True
+    )
+    seconds = perf_counter() - start
+    if result.returncode != 0:
+        print(result.stdout + result.stderr)
+        print(f"FATAL ERROR: cache.py failed in {directory}")
+        exit(-1)
+    counts = re.search(
+        "Finished downloading (\\d+) files \\((\\d+) not modified\\)", result.stdout
+    )
+    return (seconds, int(counts.group(1)), int(counts.group(2)))
+
+
+# Edits are dated a bit after now, so they are after the download before them
+def EditDate():
+    return (datetime.now(timezone.utc) + timedelta(minutes=1)).strftime(
+        "%Y-%m-%dT%H:%M:%S"
+    )
+
+
+# Runs the scenarios one after another in a new folder, and returns the results of each
+def BenchmarkCrawl(workDir, verify, golden):
+    standIn = StandIn(workDir)
+    results = {}
+    try:
+        directory = Path(workDir) / "incremental"
+        directory.mkdir()
+        state = {}
+        for scenario in SCENARIOS:
+            if scenario == "page":
+                state["pages"] = {EDITED_PAGE: "<p>Edited by the benchmark</p>"}
+                state["modified"] = {EDITED_PAGE: EditDate()}
+            elif scenario == "navbar":
+                state["navbar"] = "<p>Navbar changed by the benchmark</p>"
+            standIn.SetState(state)
+            results[scenario] = RunCache(standIn, directory)
+
+            if not verify:
+                continue
+            mirror = HashMirror(directory / "static")
+            if scenario == "cold":
+                if args.update_golden:
+                    golden["mirror"] = mirror
+                else:
+                    CompareMirrors(golden["mirror"], mirror, "the cold download")
+            elif scenario != "warm":
+                # What a download from scratch of the same site gives
+                fresh = Path(workDir) / f"fresh-{scenario}"
+                fresh.mkdir()
+                RunCache(standIn, fresh)
+                CompareMirrors(
+                    HashMirror(fresh / "static"),
+                    mirror,
+                    f"the {scenario} download (compared with a cold download)",
+                )
+            else:
+                CompareMirrors(golden["mirror"], mirror, "the warm download")
+    finally:
+        standIn.Stop()
+    return results
+
+
+def LoadCache():
+    # cache.py reads its arguments and the login when it is imported
+    sys.argv = [str(CACHE_PY)]
+    os.environ.setdefault("AUTH_BASIC_USER", standin.USER)
+    os.environ.setdefault("AUTH_BASIC_PASSWORD", standin.PASSWORD)
+    spec = importlib.util.spec_from_file_location("cache", CACHE_PY)
+    cache = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cache)
+    return cache
+
+
+# The html pages of the mirror as the site serves them: [(path, code)]
+def LoadPages():
+    pages = []
+    for page in standin.ListPages():
+        location = standin.SNAPSHOT / page.lstrip("/") / "index.html"
+        code = location.read_text("utf-8", "replace")
+        code = standin.Unconvert(code, page.rstrip("/") or "/")
+        code = code.replace("dev2.sib-utrecht.nl", "edit.sib-utrecht.nl")
+        pages.append((page.rstrip("/") or "/", code))
+    return pages
+
+
+# Returned: the number of random documents for which ScanRoutes gives another result than FindNewRoutes and
+# SubstituteRoutes
+def FuzzLinks(cache, pages):
+    snippets = set()
+    for _, code in pages:
+        for pattern, _, _ in cache.LINK_PATTERNS:
+            snippets.update(found.group() for found in pattern.finditer(code))
+    snippets = sorted(snippets)
+
+    def TwoPasses(code):
+        cache.FindNewRoutes(code, "/fuzz", True)
+        return cache.SubstituteRoutes(code, "/fuzz")
+
+    def SinglePass(code):
+        return cache.ScanRoutes(code, "/fuzz", True, substitute=True)
+
+    # The same documents every time, so the number can be compared with golden.json
+    generator = random.Random(0)
+    differing = 0
+    for _ in range(FUZZ_DOCUMENTS):
+        code = "".join(
+            generator.choice(snippets if generator.random() < 0.7 else FUZZ_GLUE)
+            for _ in range(generator.randint(1, 8))
+        )
+        outputs = []
+        for function in [TwoPasses, SinglePass]:
+            cache.routesTodo.clear()
+            try:
+                output = function(code)
+            except Exception as e:
+                # Both fail on the same documents, like a srcset with an empty entry
+                output = repr(e)
+            routes = sorted(f"{route.path}?{route.query}" for route in cache.routesTodo)
+            outputs.append((output, routes))
+        if outputs[0] != outputs[1]:
+            differing += 1
+    return differing
+
+
+# Returned: (seconds, megabytes per second) of both ways to rewrite the links
+def BenchmarkLinks(golden):
+    cache = LoadCache()
+    pages = LoadPages()
+    megabytes = sum(len(code.encode()) for (_, code) in pages) / 1e6
+
+    def TwoPasses():
+        output = []
+        for path, code in pages:
+            cache.FindNewRoutes(code, path, True)
+            output.append(cache.SubstituteRoutes(code, path))
+        return output
+
+    def SinglePass():
+        return [
+            cache.ScanRoutes(code, path, True, substitute=True)
+            for (path, code) in pages
+        ]
+
+    results = {}
+    outputs = {}
+    for name, function in [("links-two-passes", TwoPasses), ("links-scan", SinglePass)]:
+        times = []
+        for _ in range(max(3, args.repeat)):
+            cache.routesTodo.clear()
+            # Every run starts like a download does, with nothing resolved yet
+            for linkCache in cache.LINK_CACHES:
+                linkCache.cache_clear()
+            start = perf_counter()
+            outputs[name] = function()
+            times.append(perf_counter() - start)
+        routes = sorted(f"{route.path}?{route.query}" for route in cache.routesTodo)
+        outputs[name] = (outputs[name], routes)
+        results[name] = (min(times), megabytes / min(times))
+
+    substituted, routes = outputs["links-two-passes"]
+    if outputs["links-scan"] != outputs["links-two-passes"]:
+        print(
+            "FATAL ERROR: ScanRoutes gives another result than FindNewRoutes and SubstituteRoutes"
+        )
+        exit(-1)
+    links = {
+        "pages": len(pages),
+        "routes": hashlib.sha256("\n".join(routes).encode()).hexdigest(),
+        "substituted": hashlib.sha256("\0".join(substituted).encode()).hexdigest(),
+        "fuzz_differing": FuzzLinks(cache, pages),
+    }
+    if args.update_golden:
+        golden["links"] = links
+    elif links["fuzz_differing"] > golden["links"].get("fuzz_differing", 0):
+        print(
+            f"FATAL ERROR: ScanRoutes gives another result than FindNewRoutes and SubstituteRoutes for {links['fuzz_differing']} of {FUZZ_DOCUMENTS} fuzzed documents, golden.json has {golden['links'].get('fuzz_differing', 0)}"
+        )
+        exit(-1)
+    elif golden.get("links") != links:
+        print("FATAL ERROR: the links found or substituted differ from golden.json")
+        exit(-1)
+    return results
+
+
+def Main():
+    golden = {}
+    if not args.update_golden:
+        with open(GOLDEN_FILE) as f:
+            golden = json.load(f)
+
+    crawls = []
+    if not args.skip_crawl:
+        for i in range(args.repeat):
+            with tempfile.TemporaryDirectory(prefix="cache-benchmark-") as workDir:
+                # Checking the output takes extra downloads, once is enough
+                crawls.append(BenchmarkCrawl(workDir, verify=i == 0, golden=golden))
+    links = BenchmarkLinks(golden)
+
+    if args.update_golden:
+        with open(GOLDEN_FILE, "w") as f:
+            json.dump(golden, f, indent=1)
+            f.write("\n")
+        print(f"Wrote {GOLDEN_FILE}")
+
+    results = {}
+    print(
+        f"{'benchmark':<18} {'best (s)':>9} {'median (s)':>11} {'downloaded':>11} {'not modified':>13}"
+    )
+    for scenario in SCENARIOS if len(crawls) != 0 else []:
+        times = [crawl[scenario][0] for crawl in crawls]
+        _, downloaded, notModified = crawls[0][scenario]
+        results[scenario] = {
+            "best": min(times),
+            "median": statistics.median(times),
+            "downloaded": downloaded,
+            "not_modified": notModified,
+        }
+        print(
+            f"{scenario:<18} {min(times):>9.2f} {statistics.median(times):>11.2f} {downloaded:>11} {notModified:>13}"
+        )
+    for name, (seconds, throughput) in links.items():
+        results[name] = {"best": seconds, "megabytes_per_second": throughput}
+        print(f"{name:<18} {seconds:>9.3f} {'':>11} {throughput:>8.1f} MB/s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,256 @@
+# A local stand-in for the Wordpress site and the events API, serving the wget mirror in test-with-wget/ the way the
+# real site serves it: absolute links, basic auth, the wp-json listings of pages and media and ETags.
+#
+# The state file (json, read on every request) changes what is served, to simulate edits:
+#   navbar:   html that is added to the header of every page
+#   pages:    {path: html added to the end of <main> of that page}
+#   modified: {path: modification date in the listings}
+#   events:   the events the events API returns
+import argparse
+import base64
+import hashlib
+import json
+import os
+import posixpath
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+SNAPSHOT = Path(__file__).parent.parent / "test-with-wget" / "dev2.sib-utrecht.nl"
+STATE_FILE = None
+USER = "bench"
+PASSWORD = "bench"
+AUTH = "Basic " + base64.b64encode(f"{USER}:{PASSWORD}".encode()).decode()
+PUBLIC_WEBSITE = "https://edit.sib-utrecht.nl"
+DEFAULT_MODIFIED = "2024-09-01T12:00:00"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+TEXT_EXTENSIONS = (".html", ".css", ".js", ".txt", ".svg", ".json", "")
+CONTENT_TYPES = {
+    ".html": "text/html; charset=UTF-8",
+    ".css": "text/css",
+    ".js": "application/javascript",
+    ".txt": "text/plain",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+    ".woff2": "font/woff2",
+    ".pdf": "application/pdf",
+}
+
+relativeRefRegex = re.compile(
+    "(?P<pre>(?:href|src)=[\"']|url\\([\"']?)(?P<ref>(?!https?:|//|#|mailto:|data:)[^\"')]+)"
+)
+srcsetRegex = re.compile('srcset="(?P<value>[^"]*)"')
+
+
+# wget --convert-links made every link relative to the file, this makes it absolute again like Wordpress has it
+def AbsoluteRef(ref, fileDir):
+    ref = unquote(unquote(ref))
+    fragment = ""
+    if "#" in ref:
+        ref, fragment = ref.split("#", 1)
+        fragment = "#" + fragment
+    query = ""
+    if "?" in ref:
+        ref, query = ref.split("?", 1)
+        # wget added the extension after the query of versioned files, like style.css?ver=1.css
+        query = "?" + re.sub("\\.(css|html|js)$", "", query)
+    path = posixpath.normpath(posixpath.join(fileDir, ref))
+    if path.endswith("/index.html"):
+        path = path[: -len("index.html")]
+    elif path.endswith(".html") and (SNAPSHOT / path[1:-5]).is_dir():
+        path = path[:-5] + "/"
+    return PUBLIC_WEBSITE + path + query + fragment
+
+
+def Unconvert(body, fileDir):
+    def OnRef(match):
+        return match.group("pre") + AbsoluteRef(match.group("ref"), fileDir)
+
+    def OnSrcset(match):
+        sources = []
+        for source in match.group("value").split(", "):
+            split = source.split(" ", 1)
+            split[0] = AbsoluteRef(split[0], fileDir)
+            sources.append(" ".join(split))
+        return 'srcset="' + ", ".join(sources) + '"'
+
+    body = relativeRefRegex.sub(OnRef, body)
+    return srcsetRegex.sub(OnSrcset, body)
+
+
+def LoadState():
+    if STATE_FILE is None or not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE) as f:
+        return json.load(f)
+
+
+def ListPages():
+    pages = []
+    for index in sorted(SNAPSHOT.rglob("index.html")):
+        path = index.parent.relative_to(SNAPSHOT).as_posix()
+        if path.startswith("wp-") or "feed" in path:
+            continue
+        pages.append("/" if path == "." else f"/{path}/")
+    return pages
+
+
+def ListMedia():
+    media = []
+    for file in sorted((SNAPSHOT / "wp-content" / "uploads").rglob("*")):
+        if file.suffix.lower() in IMAGE_EXTENSIONS:
+            media.append("/" + file.relative_to(SNAPSHOT).as_posix())
+    return media
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def Send(self, status, body, contentType, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if status == 304:
+            body = b""
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path = unquote(url.path)
+        state = LoadState()
+
+        if path.startswith("/v2/events"):
+            events = state.get(
+                "events", [{"id": "1", "$.modified": "2024-09-01T12:00:00+00:00"}]
+            )
+            body = json.dumps({"data": {"events": events}}).encode()
+            return self.Send(200, body, "application/json")
+
+        if self.headers.get("Authorization") != AUTH:
+            return self.Send(401, b"Unauthorized", "text/plain")
+
+        if path.startswith("/wp-json/wp/v2/"):
+            return self.SendListing(path, query, state)
+        return self.SendFile(path, state)
+
+    def SendListing(self, path, query, state):
+        host = f"http://{self.headers['Host']}"
+        modified = state.get("modified", {})
+        if path.rstrip("/").endswith("/media"):
+            items = [
+                {
+                    "modified": modified.get(media, DEFAULT_MODIFIED),
+                    "link": host + media,
+                    "source_url": host + media,
+                    "media_details": {"sizes": {}},
+                }
+                for media in ListMedia()
+            ]
+        else:
+            items = [
+                {
+                    "modified": modified.get(page.rstrip("/") or "/", DEFAULT_MODIFIED),
+                    "link": host + page,
+                    "content": {"rendered": "x" * 2000},
+                }
+                for page in ListPages()
+            ]
+
+        if "modified_after" in query:
+            after = query["modified_after"][0][:19]
+            items = [item for item in items if item["modified"] > after]
+        if "_fields" in query:
+            fields = query["_fields"][0].split(",")
+            items = [
+                {
+                    key: value
+                    for (key, value) in item.items()
+                    if any(field.split(".")[0] == key for field in fields)
+                }
+                for item in items
+            ]
+
+        perPage = int(query.get("per_page", ["10"])[0])
+        page = int(query.get("page", ["1"])[0])
+        totalPages = max(1, (len(items) + perPage - 1) // perPage)
+        if page > totalPages:
+            body = b'{"code":"rest_post_invalid_page_number"}'
+            return self.Send(400, body, "application/json")
+        body = json.dumps(items[(page - 1) * perPage : page * perPage]).encode()
+        headers = {"X-WP-Total": str(len(items)), "X-WP-TotalPages": str(totalPages)}
+        return self.Send(200, body, "application/json", headers)
+
+    def SendFile(self, path, state):
+        candidates = [path + "index.html"]
+        if not path.endswith("/"):
+            candidates = [path, path + "/index.html", path + ".html"]
+        file = SNAPSHOT / "404.html"
+        for candidate in candidates:
+            candidate = SNAPSHOT / candidate.lstrip("/")
+            if candidate.is_file():
+                file = candidate
+                break
+            # wget kept the query of versioned files in the file name
+            versioned = sorted(candidate.parent.glob(candidate.name + "?*"))
+            if candidate.parent.is_dir() and len(versioned) != 0:
+                file = versioned[0]
+                break
+        body = file.read_bytes()
+        status = 404 if file.name == "404.html" else 200
+
+        extension = os.path.splitext(file.name.split("?")[0])[1].lower()
+        contentType = CONTENT_TYPES.get(extension, "application/octet-stream")
+        if extension in TEXT_EXTENSIONS:
+            fileDir = "/" + file.parent.relative_to(SNAPSHOT).as_posix()
+            text = Unconvert(
+                body.decode("utf-8", "replace"), fileDir.rstrip("/.") or "/"
+            )
+            body = text.replace("dev2.sib-utrecht.nl", "edit.sib-utrecht.nl").encode()
+            if extension == ".html":
+                navbar = state.get("navbar")
+                if navbar:
+                    header = b'<header class="wp-block-template-part">'
+                    body = body.replace(header, header + navbar.encode())
+                edit = state.get("pages", {}).get(path.rstrip("/") or "/")
+                if edit:
+                    body = body.replace(b"</main>", edit.encode() + b"</main>")
+
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            return self.Send(304, b"", contentType, {"ETag": etag})
+        return self.Send(status, body, contentType, {"ETag": etag})
+
+
+class Server(ThreadingHTTPServer):
+    # cache.py closes connections it doesn't need anymore, that isn't an error
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--snapshot", help="The wget mirror to serve", default=SNAPSHOT)
+    parser.add_argument("--port", help="0 picks a free port", type=int, default=8765)
+    parser.add_argument("--state", help="Json file with the edits to serve")
+    args = parser.parse_args()
+    SNAPSHOT = Path(args.snapshot)
+    STATE_FILE = args.state
+
+    server = Server(("127.0.0.1", args.port), Handler)
+    print(f"Serving {SNAPSHOT} on http://127.0.0.1:{server.server_port}", flush=True)
+    server.serve_forever()
@@ -1,18 +1,50 @@
-import subprocess
 import requests
 import os
+import json
+import hashlib
 import re
+import difflib
+import mimetypes
 import argparse
 import traceback
 import shutil
+import errno
+import threading
+import heapq
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from time import sleep
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from pathlib import PurePosixPath
-from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from pathlib import Path
 import pytz
+import gzip
+import io
+import posixpath
+import tarfile
+import zipfile
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 from time import perf_counter
 
 tz = pytz.timezone("Europe/Amsterdam")
@@ -37,16 +69,98 @@ parser.add_argument(
     help="Create a static site for offline use instead of serving",
     action="store_true",
 )
+parser.add_argument(
+    "--offline-archive",
+    help="Also pack the site for offline use into this .zip, .tar.gz, .tar.xz or .tar.zst (if zstandard is installed) file, with relative links so it can be opened anywhere. Implies --offline-use",
+)
 parser.add_argument("--root", help="Starting point", default="/")
+parser.add_argument(
+    "--keep-generations",
+    help="Number of previous downloads to keep next to the current one, for --rollback",
+    type=int,
+    default=2,
+)
+parser.add_argument(
+    "--stored-in-git",
+    help="The output folder is committed to git, which doesn't keep hardlinks: don't use the store of downloads shared by the generations, and only keep the generation that is served. Implies --keep-generations 0",
+    action="store_true",
+)
+parser.add_argument(
+    "--rollback",
+    help="Serve the previous download again instead of downloading the site",
+    action="store_true",
+)
+parser.add_argument(
+    "--full-sync",
+    help="Get the modification dates of all media and pages, instead of only the ones changed since the previous download",
+    action="store_true",
+)
+parser.add_argument(
+    "--full-sync-days",
+    help="Also get the modification dates of all media and pages if the previous time that was done is this many days ago, so pages that were removed from Wordpress are dropped from the mirror",
+    type=float,
+    default=1,
+)
+parser.add_argument(
+    "--precompress",
+    help="Also write .gz (and .br if brotli is installed) files next to html, css, js and svg files, for servers that serve precompressed files",
+    action="store_true",
+)
+parser.add_argument(
+    "--image-variants",
+    help="Comma separated formats (webp, avif) to also encode the jpeg and png images in, which are offered to browsers with <picture>",
+    default="",
+)
+parser.add_argument(
+    "--regenerate",
+    help="Comma separated types of files (html, css, js, ...) that are downloaded and rewritten again instead of kept from the previous download, after a change to how they are rewritten",
+    default="",
+)
+parser.add_argument(
+    "--changed",
+    help="Only download these pages (paths or urls) and the pages that link to them again, and keep the rest of the previous download",
+    nargs="+",
+    default=[],
+)
+parser.add_argument(
+    "--changed-file",
+    help="Like --changed, with the pages in this file: one path or url per line, or the changed= parameters in the lines of an access log",
+)
+parser.add_argument(
+    "--report",
+    help="Write the timings of the phases, counts, bytes and slowest routes of this run to this json file",
+)
+parser.add_argument(
+    "--prometheus-textfile",
+    help="Also write the metrics of this run in the Prometheus text format to this file, for the textfile collector of node_exporter",
+)
+parser.add_argument(
+    "--concurrency",
+    help="Number of routes (and pages of the modification dates) that are fetched in parallel",
+    type=int,
+    default=1,
+)
 args = parser.parse_args()
+if args.offline_archive is not None:
+    args.offline_use = True
+if args.stored_in_git:
+    args.keep_generations = 0
 
-website = "https://edit-unauth.sib-utrecht.nl"
+# Can be pointed somewhere else, like the local stand-in of the benchmark
+website = os.getenv("WEBSITE_URL", "https://edit-unauth.sib-utrecht.nl")
 alternate_website = "https://edit.sib-utrecht.nl"
+events_api = os.getenv("EVENTS_API_URL", "https://api2.sib-utrecht.nl/v2/events")
 
 OUTPUT_DIR_OFFLINE = "cache"
 OUTPUT_DIR_HTTP = "static"
 OUTPUT_DIR = OUTPUT_DIR_OFFLINE if args.offline_use else OUTPUT_DIR_HTTP
-TEMP_DIR = Path.cwd() / "temp"
+# Every download is made in a new numbered folder in here, OUTPUT_DIR is a symlink to the one that is served
+GENERATIONS_DIR = Path(f"{OUTPUT_DIR}.generations")
+# The downloads that aren't rewritten (media, documents, fonts) are kept once per content in here, under their sha256,
+# and the generations are hardlinks to them: the same upload is often served under several paths
+BLOBS_DIR = GENERATIONS_DIR / "blobs"
+# The folder of the generation that is being downloaded, set up by SetupUpdate
+BUILD_DIR = None
 
 auth_user = os.getenv("AUTH_BASIC_USER")
 auth_password = os.getenv("AUTH_BASIC_PASSWORD")
@@ -66,10 +180,17 @@ params = {"noauth": "true"}
 # If they differ then the navbar changed and all html need to be downloaded again
 firstUptoDateHtmlFile = True
 htmlsDeleted = False
+# Set once the navbar check above is done, other up to date html files wait for it when crawling concurrently
+navbarChecked = threading.Event()
+navbarProbePath = None
+# If only the header/footer changed: (old chrome hash, new chrome hash, patches), see CheckChrome
+chromeChange = None
 
-# These files change regularly because of activities so we always force redownload them
-# It was originally handled by deleting them beforehand but we do this so we can compare the new file with the original to prevent updating the timestamp unnecessarily
-alwaysRedownload = ["/", "/activities", "/meet-sib"]
+# These pages list the activities, so they change without being modified in Wordpress. They are downloaded again when
+# their freshness key (see GetFreshnessKey) changes
+listingPages = ["/", "/activities", "/meet-sib"]
+# With --changed: the routes that are downloaded again, the rest is kept from the previous download
+changedRoutes = None
 
 
 class Route:
@@ -101,25 +222,76 @@ class Route:
         )
 
 
-routesTodo = {
-    Route(args.root + "404.html", args.root + "404.html", "404"),
-    Route(
-        args.root, args.root, "root point", query=f"?cache={datetime.now().timestamp()}"
-    ),
-    Route(
-        args.root + "restricted/documents",
-        args.root + "restricted/documents",
-        "entrance",
-    ),
-    Route(args.root + "symposium", args.root + "symposium", "symposium"),
-    Route(
-        args.root + "activities",
-        args.root + "activities",
-        "symposium",
-        f"?cache={datetime.now().timestamp()}",
-    ),
-}
+# Lower goes first: the pages that are always downloaded and the 404 page (which is never outdated by a modification
+# date, so it is the first up to date html file that checks the navbar), then the other pages, their stylesheets and
+# scripts, and the media last
+def GetPriority(route):
+    if route.path in listingPages or route.path == "/404.html":
+        return 0
+    if "." not in route.path or route.path.endswith(".html"):
+        return 1
+    if route.path.endswith((".css", ".js")):
+        return 2
+    return 3
+
+
+# The routes that still have to be handled, like a set of routes (by path) that pops the route with the lowest
+# priority first, and routes with the same priority in the order they were added
+class Frontier:
+    def __init__(self, routes=()):
+        self.heap = []
+        self.paths = set()
+        self.added = 0
+        for route in routes:
+            self.add(route)
+
+    def add(self, route):
+        if route.path in self.paths:
+            return
+        self.paths.add(route.path)
+        heapq.heappush(self.heap, (GetPriority(route), self.added, route))
+        self.added += 1
+
+    def pop(self):
+        (_, _, route) = heapq.heappop(self.heap)
+        self.paths.remove(route.path)
+        return route
+
+    def clear(self):
+        self.heap = []
+        self.paths = set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __iter__(self):
+        return (route for (_, _, route) in sorted(self.heap))
+
+
+routesTodo = Frontier(
+    [
+        Route(args.root + "404.html", args.root + "404.html", "404"),
+        Route(args.root, args.root, "root point"),
+        Route(
+            args.root + "restricted/documents",
+            args.root + "restricted/documents",
+            "entrance",
+        ),
+        Route(args.root + "symposium", args.root + "symposium", "symposium"),
+        Route(args.root + "activities", args.root + "activities", "symposium"),
+    ]
+)
 routesDone = set()
+# Routes that are currently being handled by one of the workers
+routesInProgress = set()
+# Guards routesTodo, routesDone, routesInProgress, scannedLinks and the counters shared between workers
+routesLock = threading.Lock()
+# The links found in the routes that are being scanned, {path: {linked path: query}} in the order they were found.
+# They are kept in the manifest, so the next download doesn't have to open the route again if it didn't change
+scannedLinks = {}
 
 routesDone.add("/restricted/")
 routesDone.add("/restricted")
@@ -131,24 +303,232 @@ routesDone.add("/signout/")
 USE_FILE_LOCATION = args.offline_use
 
 session = requests.session()
-retry = Retry(connect=3, backoff_factor=0.5)  # type: ignore
-adapter = HTTPAdapter(max_retries=retry)
+# Only for connection errors, the responses that say the server is busy are retried by Request
+retry = Retry(connect=3, backoff_factor=0.5, respect_retry_after_header=False)  # type: ignore
+adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(10, args.concurrency))
 session.mount("http://", adapter)
 session.mount("https://", adapter)
 
+# Responses after which the same request is tried again a bit later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+# Without a Retry-After header, retrying waits 1, 2, 4, ... seconds, give or take half of that
+RETRY_BACKOFF = 1.0
+# A server that wants us to wait longer than this is not going to answer today
+MAX_RETRY_AFTER = 120
+# Responses that take longer than this mean the server is getting too busy
+SLOW_RESPONSE = 2.0
+# Seconds to wait for a connection or for the next bytes of a response, so a server that stopped answering doesn't keep
+# a worker forever
+REQUEST_TIMEOUT = 60
+
+
+# Spaces the requests of all workers to the site: the time between two requests grows when responses get slow or the
+# server says it is busy, and shrinks again while the responses are fast
+class RateController:
+    def __init__(self, interval, minInterval, maxInterval):
+        self.interval = interval
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.nextRequest = 0.0
+        self.lock = threading.Lock()
+
+    # Waits until this worker may send its request
+    def Wait(self):
+        with self.lock:
+            now = perf_counter()
+            start = max(now, self.nextRequest)
+            self.nextRequest = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+    def Record(self, seconds, status):
+        with self.lock:
+            if status in RETRY_STATUSES:
+                self.interval = min(self.maxInterval, max(self.interval, 0.05) * 2)
+            elif seconds > SLOW_RESPONSE:
+                self.interval = min(self.maxInterval, max(self.interval, 0.05) * 1.5)
+            else:
+                self.interval = max(self.minInterval, self.interval * 0.9)
+
+    # No worker sends a request in the coming seconds
+    def Pause(self, seconds):
+        with self.lock:
+            self.nextRequest = max(self.nextRequest, perf_counter() + seconds)
+
+
+rateController = RateController(interval=0.05, minInterval=0.005, maxInterval=5.0)
+
+
+# Returned: the seconds the Retry-After header of the response asks to wait, or None if it doesn't have one
+def GetRetryAfter(r):
+    value = r.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retryAt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retryAt - datetime.now(timezone.utc)).total_seconds())
+
+
+# session.get through the rate controller, retrying when the server is busy or has a temporary error. The last
+# response is returned if it keeps failing
+def Request(url, **kwargs):
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    for attempt in range(MAX_ATTEMPTS):
+        rateController.Wait()
+        start = perf_counter()
+        r = session.get(url, **kwargs)
+        rateController.Record(perf_counter() - start, r.status_code)
+        if r.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            return r
+
+        delay = GetRetryAfter(r)
+        if delay is None:
+            delay = RETRY_BACKOFF * 2**attempt * random.uniform(0.5, 1.5)
+        elif delay > MAX_RETRY_AFTER:
+            return r
+        r.close()
+        printdev(
+            f"Status {r.status_code} for {url}, trying again in {delay:.1f} seconds"
+        )
+        Count("retries")
+        # The server is busy for all workers, not only this one
+        rateController.Pause(delay)
+    return r
+
 
 fileLocation = "file://"
 
 
-def WriteFile(location, codeBytes):
-    os.makedirs(os.path.dirname(location), exist_ok=True)
-    file = open(location, "wb")
-    file.write(codeBytes)
-    file.close()
+# Files are written to the new generation by threads of their own, so the workers go on with the next request while the
+# disk is busy. Files that fail to be written are reported by Flush at the end of the download
+WRITER_THREADS = 4
+# The workers wait when this many files are waiting to be written, so the queue doesn't hold the whole site in memory
+MAX_QUEUED_WRITES = 256
+
+
+class FileWriter:
+    def __init__(self, threads, maxQueued):
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="writer"
+        )
+        self.queued = threading.BoundedSemaphore(maxQueued)
+        self.lock = threading.Lock()
+        # {location: future} of the files that are waiting to be written, the location normalised (see Key)
+        self.pending = {}
+        # (location, path of the route, exception, traceback) of the files that couldn't be written
+        self.failures = []
+        # The directories that exist already, so they aren't created for every file
+        self.directories = set()
+
+    def MakeDirs(self, directory):
+        if directory in self.directories:
+            return
+        os.makedirs(directory, exist_ok=True)
+        while directory not in self.directories and directory not in ("", "/"):
+            self.directories.add(directory)
+            directory = os.path.dirname(directory)
+
+    # The same file can be given as a Path or a string, and the homepage as .../000003//index.html (GetNewUrl) or
+    # .../000003/index.html (Path removes the double slash)
+    @staticmethod
+    def Key(location):
+        return os.path.normpath(str(location))
+
+    # Returned: a future that is done when the file is written
+    # path: the route the file belongs to
+    def Submit(self, location, path, function, *arguments):
+        location = str(location)
+        self.queued.acquire()
+        with self.lock:
+            future = self.executor.submit(self.Run, location, path, function, arguments)
+            self.pending[self.Key(location)] = future
+        return future
+
+    def Run(self, location, path, function, arguments):
+        try:
+            function(*arguments)
+        except Exception as e:
+            with self.lock:
+                self.failures.append((location, path, e, traceback.format_exc()))
+        finally:
+            with self.lock:
+                self.pending.pop(self.Key(location), None)
+            self.queued.release()
+
+    # Waits until the file at this location is written, if it is waiting to be written
+    def Wait(self, location):
+        with self.lock:
+            future = self.pending.get(self.Key(location))
+        if future is not None:
+            with Measure("write_wait"):
+                future.result()
+
+    # Waits until all files are written. The routes of files that failed are left out of the manifest
+    def Flush(self):
+        with self.lock:
+            futures = list(self.pending.values())
+        with Measure("write_wait"):
+            wait(futures)
+        with self.lock:
+            (failures, self.failures) = (self.failures, [])
+        for location, path, e, trace in failures:
+            Count("routes_failed")
+            RecordFailedRoute(path)
+            changedFiles.discard(location)
+            if args.verbose:
+                print(f"Something went wrong while writing {location}")
+                print(repr(e))
+                print(trace)
+                exit(-1)
+            print(f"\n{WARNING_TAG} writing {location} failed")
+            printdev(repr(e))
+
+
+fileWriter = FileWriter(WRITER_THREADS, MAX_QUEUED_WRITES)
+
+
+# Files of the previous generation are hardlinked instead of moved, so that generation stays intact for --rollback
+def CarryOver(origPath, destPath, path=None):
+    Count("files_carried_over")
+    return fileWriter.Submit(destPath, path, LinkFile, origPath, destPath)
+
+
+def LinkFile(origPath, destPath):
+    with Measure("write"):
+        fileWriter.MakeDirs(os.path.dirname(destPath))
+        try:
+            os.link(origPath, destPath)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                raise
+            shutil.copy2(origPath, destPath)
+    AddToArchive(destPath, unchanged=True)
+
+
+def WriteFile(location, codeBytes, path=None):
+    Count("files_written")
+    Count("bytes_written", len(codeBytes))
+    return fileWriter.Submit(location, path, WriteBytes, location, codeBytes)
+
+
+def WriteBytes(location, codeBytes):
+    with Measure("write"):
+        fileWriter.MakeDirs(os.path.dirname(location))
+        file = open(location, "wb")
+        file.write(codeBytes)
+        file.close()
+    AddToArchive(location, codeBytes)
 
 
 def GetFileLocationFromURL(path, use_orig, appendix="/index.html"):
-    out_dir = OUTPUT_DIR_OFFLINE if use_orig else "temp"
+    out_dir = OUTPUT_DIR_OFFLINE if use_orig else BUILD_DIR
     if "." in path:
         return out_dir + path
     return out_dir + path + appendix
@@ -164,7 +544,7 @@ def GetNewUrl(
         return fileLocation + os.path.abspath(rel_path)
 
     if for_writing:
-        out_dir = OUTPUT_DIR_HTTP if use_orig else "temp"
+        out_dir = OUTPUT_DIR_HTTP if use_orig else BUILD_DIR
         if "." in path:
             return out_dir + path
 
@@ -193,6 +573,7 @@ def GetUrlFromFileLocation(filepath: str) -> str:
     return filepath
 
 
+# Older downloads kept the metadata of every file in .time, .query and .validators files next to it
 def GetLocationOfTimestampFromURL(path, use_orig):
     return f"{GetNewUrl(path, for_writing=True, use_orig=use_orig)}.time"
 
@@ -201,55 +582,255 @@ def GetLocationOfQueryFromURL(path, use_orig):
     return f"{GetNewUrl(path, for_writing=True, use_orig=use_orig)}.query"
 
 
+def GetLocationOfValidatorsFromURL(path, use_orig):
+    return f"{GetNewUrl(path, for_writing=True, use_orig=use_orig)}.validators"
+
+
+# The metadata of all files in the output folder, one json object per line with
+# path, time (of the last change), query, hash (sha256 of the file), validators (ETag/Last-Modified), the links in it
+# and the freshness key of the pages in listingPages. With --image-variants also the jpeg/png images that failed, as
+# "failed" with no variants (see RecordFailedRoute)
+MANIFEST_FILE = ".manifest.jsonl"
+
+# The manifest of the previous download, or None if that download still used the separate files
+previousManifest = None
+# The manifest of this download, written to the output folder at the end
+manifest = {}
+
+
+def LoadManifest():
+    global previousManifest
+    try:
+        with open(Path(OUTPUT_DIR) / MANIFEST_FILE) as f:
+            previousManifest = {}
+            for line in f:
+                entry = json.loads(line)
+                previousManifest[entry["path"]] = entry
+    except IOError:
+        printdev(
+            f"{WARNING_TAG} No manifest in {OUTPUT_DIR}, reading the .time/.query files of the previous download instead"
+        )
+
+
+def WriteManifest(location):
+    with open(location, "w") as f:
+        for path in sorted(manifest):
+            f.write(json.dumps(manifest[path], separators=(",", ":")) + "\n")
+
+
+def ReadLegacyEntry(route):
+    try:
+        with open(GetLocationOfTimestampFromURL(route.path, use_orig=True)) as f:
+            entry = {"path": route.path, "time": f.read()}
+    except IOError:
+        return None
+    try:
+        with open(GetLocationOfQueryFromURL(route.path, use_orig=True)) as f:
+            entry["query"] = f.read()
+    except IOError:
+        pass
+    try:
+        with open(GetLocationOfValidatorsFromURL(route.path, use_orig=True)) as f:
+            entry["validators"] = json.load(f)
+    except (IOError, ValueError):
+        pass
+    return entry
+
+
+# The manifest entry of the route from the previous download, or None if it wasn't there
+def GetPreviousEntry(route):
+    if previousManifest is None:
+        return ReadLegacyEntry(route)
+    entry = previousManifest.get(route.path)
+    if entry is not None and entry.get("failed"):
+        return None
+    return entry
+
+
 numdownloaded = 0
+numnotmodified = 0
+
+# Metrics of this run for --report and --prometheus-textfile. The seconds of a phase are summed over the threads
+metricsLock = threading.Lock()
+phaseSeconds = {}
+counts = {
+    name: 0
+    for name in [
+        "routes_downloaded",
+        "routes_patched",
+        "routes_reused",
+        "routes_failed",
+        "retries",
+        "files_written",
+        "files_carried_over",
+        "bytes_downloaded",
+        "bytes_written",
+    ]
+}
+# (seconds, path) of every request to the site, and of every route from start to end
+downloadSeconds = []
+routeSeconds = []
+
+
+def Count(name, amount=1):
+    with metricsLock:
+        counts[name] = counts.get(name, 0) + amount
+
+
+@contextmanager
+def Measure(phase, samples=None, path=None):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        with metricsLock:
+            phaseSeconds[phase] = phaseSeconds.get(phase, 0) + seconds
+            if samples is not None:
+                samples.append((seconds, path))
+
+
+# The files in the new generation that were written with other content than in the previous one, for .changes.json
+changedFiles = set()
+
 
+# A download that was written to the new generation while it came in, instead of being kept in memory
+class StreamedFile:
+    def __init__(self, location, digest):
+        self.location = location
+        self.digest = digest
 
-def Download(path):
-    global numdownloaded
-    numdownloaded += 1
+
+# Writes the response to the new generation in chunks, hashing it on the way
+def StreamToFile(r, location):
+    fileWriter.MakeDirs(os.path.dirname(location))
+    digest = hashlib.sha256()
+    # Written under another name first, so a broken download doesn't leave half a file behind
+    partial = f"{location}.part"
+    try:
+        with open(partial, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1 << 16):
+                digest.update(chunk)
+                f.write(chunk)
+                Count("bytes_downloaded", len(chunk))
+                Count("bytes_written", len(chunk))
+    except:
+        # Otherwise it is listed (and synced) as a new file of the generation
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+    os.replace(partial, location)
+    Count("files_written")
+    if not args.stored_in_git:
+        StoreBlob(location, digest.hexdigest())
+    AddToArchive(location)
+    return StreamedFile(location, digest.hexdigest())
+
+
+# Makes the file at location a hardlink of the blob with the same content, or adds it to the store if it is new
+def StoreBlob(location, digest):
+    blob = str(BLOBS_DIR / digest[:2] / digest)
+    try:
+        fileWriter.MakeDirs(os.path.dirname(blob))
+        try:
+            os.link(location, blob)
+            Count("blobs_added")
+            return
+        except FileExistsError:
+            pass
+        size = os.path.getsize(location)
+        # Linked under another name first, so the file is never missing
+        os.link(blob, f"{location}.blob")
+        os.replace(f"{location}.blob", location)
+        Count("blobs_reused")
+        Count("bytes_deduplicated", size)
+    except OSError as e:
+        # The file stays as it is where hardlinks aren't possible
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+            raise
+
+
+# Removes the blobs that no generation links to anymore. With --stored-in-git that is the whole store a download
+# from before left, git checks the files out without their hardlinks
+def DeleteUnusedBlobs():
+    if not BLOBS_DIR.is_dir():
+        return
+    for directory in BLOBS_DIR.iterdir():
+        for blob in directory.iterdir():
+            if blob.stat().st_nlink == 1:
+                blob.unlink()
+                Count("blobs_deleted")
+
+
+# Returned: (content, validators, contentType), content is None if the server answered 304 Not Modified,
+# and a StreamedFile if it isn't rewritten and was written to the new generation directly
+def Download(path, validators={}):
+    global numdownloaded, numnotmodified
+    with routesLock:
+        numdownloaded += 1
+    location = GetNewUrl(path, for_writing=True)
     # paths are stored here without the ending slash, but for some reasons dutch pages like /nl/structure redirect to /structure, but /nl/structure/ does not
     if not path.endswith("/") and "." not in path:
         path += "/"
-    r = session.get(website + path, auth=auth, params=params)
-    sleep(0.05)
-    if r.status_code == 404 and path.endswith("/404.html"):
-        return r.content
-
-    # Also fails on 404
-    r.raise_for_status()
-    return r.content
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last-modified" in validators:
+        headers["If-Modified-Since"] = validators["last-modified"]
+    with Measure("download", downloadSeconds, path), Request(
+        website + path, auth=auth, params=params, headers=headers, stream=True
+    ) as r:
+        if r.status_code == 304:
+            with routesLock:
+                numnotmodified += 1
+            return None, validators, None
+        contentType = GetContentType(path, r.headers.get("Content-Type"))
+        if r.status_code == 404 and path.endswith("/404.html"):
+            Count("bytes_downloaded", len(r.content))
+            return r.content, {}, contentType
+
+        # Also fails on 404
+        r.raise_for_status()
+        newValidators = {}
+        if "ETag" in r.headers:
+            newValidators["etag"] = r.headers["ETag"]
+        if "Last-Modified" in r.headers:
+            newValidators["last-modified"] = r.headers["Last-Modified"]
+        if PROCESSORS.get(contentType) is None:
+            return StreamToFile(r, location), newValidators, contentType
+        Count("bytes_downloaded", len(r.content))
+        return r.content, newValidators, contentType
 
 
 # Returned: is the query different from last time?
-def ReadAndUpdateQueryFile(route):
-    os.makedirs(
-        os.path.dirname(GetLocationOfQueryFromURL(route.path, use_orig=False)),
-        exist_ok=True,
-    )
-    try:
-        with open(GetLocationOfQueryFromURL(route.path, use_orig=True), "r") as f:
-            contents = f.read()
-        if contents != route.query:
-            with open(GetLocationOfQueryFromURL(route.path, use_orig=False), "w") as f:
-                f.write(route.query)
-            return True
-        subprocess.run(
-            [
-                "mv",
-                GetLocationOfQueryFromURL(route.path, use_orig=True),
-                GetLocationOfQueryFromURL(route.path, use_orig=False),
-            ]
-        )
-        return False
-    except IOError:
-        printdev(f"{WARNING_TAG} Query file for route {route} did not yet exist")
-        with open(GetLocationOfQueryFromURL(route.path, use_orig=False), "w") as f:
-            f.write(route.query)
-            return True
+def QueryChanged(route, previous):
+    if "query" not in previous:
+        printdev(f"{WARNING_TAG} Query for route {route} was not yet known")
+        return True
+    return previous["query"] != route.query
 
 
-def ShouldRedownload(route, time):
+# The types of files that --regenerate downloads again, by extension (pages count as html)
+REGENERATE = {type.strip().lstrip(".") for type in args.regenerate.split(",")} - {""}
+
+
+def MustRegenerate(route):
+    if "." not in route.path or route.path.endswith(".html"):
+        return "html" in REGENERATE
+    return route.path.rsplit(".", 1)[-1].lower() in REGENERATE
+
+
+def ShouldRedownload(route, previous):
+    time = datetime.fromisoformat(previous["time"]).replace(tzinfo=timezone.utc)
     # assert not(route.query != "" and not(route.path.endswith(".js") or route.path.endswith('.css')))
+    isHtml = "." not in route.path or route.path.endswith(".html")
+    if MustRegenerate(route):
+        return True
+    if isHtml and previous.get("images", "") != IMAGE_VARIANTS_SIGNATURE:
+        # The <picture> elements for --image-variants are added while downloading
+        return True
+    if changedRoutes is not None and route.path in changedRoutes:
+        return True
     if route.path == "/404.html":
         return False
     if route.path.startswith("/restricted"):
@@ -257,11 +838,16 @@ def ShouldRedownload(route, time):
     if route.path.endswith(".woff2"):
         return False
     if route.path.endswith(".js") or route.path.endswith(".css"):
-        return ReadAndUpdateQueryFile(route)
-    if route.path in alwaysRedownload:
-        return True
-    if ("." not in route.path or route.path.endswith(".html")) and htmlsDeleted:
+        return QueryChanged(route, previous)
+    if changedRoutes is not None:
+        # The modification dates weren't asked, only the header/footer can make other files outdated
+        return isHtml and htmlsDeleted
+    if isHtml and htmlsDeleted:
         return True
+    if route.path in listingPages:
+        return previous.get("freshness") != GetFreshnessKey(
+            route.path, previous.get("links")
+        )
 
     path = route.path
     try:
@@ -274,53 +860,116 @@ def ShouldRedownload(route, time):
     return True
 
 
-# Return (content, wasDownloaded, originalcontent, specialcase) (originnalcontent only if it was downloaded and it already existed)
+def ReadPreviousFile(route):
+    with open(GetNewUrl(route.path, for_writing=True, use_orig=True), "rb") as f:
+        return f.read()
+
+
+# Returned: the file of the previous download, or None if it doesn't have to be opened because the manifest has
+# its hash and its links (or it is a type of file without links)
+def ReadPreviousIfNeeded(route, previous):
+    if (
+        "hash" in previous
+        and "type" in previous
+        and ("links" in previous or PROCESSORS.get(previous["type"]) is None)
+    ):
+        return None
+    return ReadPreviousFile(route)
+
+
+# Return (content, wasDownloaded, originalcontent, specialcase, validators, wasPatched, contentType) (originnalcontent only for the first up to date html file, to check the navbar)
+# content: None if the previous download is kept and didn't have to be opened
+# wasPatched: the file of the previous download with the new header/footer put in
+# contentType: only if it was downloaded
 def Get(route):
     originalcontent = ""
     specialCase = False
-    if os.path.exists(GetNewUrl(route.path, for_writing=True, use_orig=True)):
-        with open(GetLocationOfTimestampFromURL(route.path, use_orig=True)) as f:
-            time = datetime.fromisoformat(f.read()).replace(tzinfo=timezone.utc)
-        shouldRedownload = ShouldRedownload(route, time)
-
-        global firstUptoDateHtmlFile
-        if (
-            not shouldRedownload
-            and (
-                "." not in route.path or route.path.endswith(".html")
-            )  # is it an html file?, 404.html ends in html but most others don't
-            and firstUptoDateHtmlFile
-        ):
-            specialCase = True
-            firstUptoDateHtmlFile = False
+    validators = {}
+    previous = GetPreviousEntry(route)
+    if previous is not None and os.path.exists(
+        GetNewUrl(route.path, for_writing=True, use_orig=True)
+    ):
+        shouldRedownload = ShouldRedownload(route, previous)
+
+        global firstUptoDateHtmlFile, navbarProbePath
+        isUptoDateHtml = not shouldRedownload and (
+            "." not in route.path or route.path.endswith(".html")
+        )  # is it an html file?, 404.html ends in html but most others don't
+        with routesLock:
+            if isUptoDateHtml and firstUptoDateHtmlFile:
+                specialCase = True
+                firstUptoDateHtmlFile = False
+                navbarProbePath = route.path
+        if specialCase:
             shouldRedownload = True
             printdev(
                 f"First up to date html file: {route.path}, checking for changes to navbar"
             )
+        elif isUptoDateHtml and not navbarChecked.is_set():
+            # Another worker is still checking the navbar, its outcome decides whether this file is up to date
+            navbarChecked.wait()
+            shouldRedownload = ShouldRedownload(route, previous)
         if not shouldRedownload:
-            with open(
-                GetNewUrl(route.path, for_writing=True, use_orig=True), "rb"
-            ) as f:
-                if args.verbose:
-                    printdev(f"Moving file {route.path} from previous download...")
-                return (f.read(), False, {}, False)
-        else:
-            printdev(f"File {route.path} is invalidated and will be redownloaded...")
-            with open(
-                GetNewUrl(route.path, for_writing=True, use_orig=True), "rb"
-            ) as f:
-                originalcontent = f.read()
+            if (
+                isUptoDateHtml
+                and chromeChange is not None
+                and previous.get("chrome") != chromeChange[1]
+            ):
+                patched = None
+                if previous.get("chrome") == chromeChange[0]:
+                    patched = PatchChrome(ReadPreviousFile(route).decode("utf-8"))
+                if patched is not None:
+                    printdev(f"Patching header/footer of {route.path}")
+                    return (patched.encode("utf-8"), False, {}, False, {}, True, None)
                 printdev(
-                    f"original content was {GetNewUrl(route.path, for_writing=True, use_orig=True)}"
+                    f"Header/footer of {route.path} can't be patched, it will be redownloaded"
                 )
-    else:
-        printdev(
-            f"Info: File {route.path} did not exist in previous download or was explicitly removed (index.html, activities, ...) or was invalidated by update to navbar/theme: downloading..."
+                shouldRedownload = True
+        if not shouldRedownload:
+            if args.verbose:
+                printdev(f"Moving file {route.path} from previous download...")
+            content = ReadPreviousIfNeeded(route, previous)
+            return (content, False, {}, False, {}, False, None)
+
+        printdev(f"File {route.path} is invalidated and will be redownloaded...")
+        # The ETag and Last-Modified headers of the previous download make the request conditional
+        validators = previous.get("validators", {})
+        if previous.get("images", "") != IMAGE_VARIANTS_SIGNATURE or MustRegenerate(
+            route
+        ):
+            # A page the server didn't change still needs other <picture> elements, or is rewritten again
+            validators = {}
+        (newfile, validators, contentType) = Download(route.path, validators)
+        if newfile is None:
+            # Not modified on the server, so the previous download is still correct and needs no rewriting
+            printdev(f"File {route.path} was not modified, keeping previous download")
+            content = ReadPreviousIfNeeded(route, previous)
+            return (content, False, {}, False, validators, False, None)
+        if specialCase:
+            originalcontent = ReadPreviousFile(route)
+        return (
+            newfile,
+            True,
+            originalcontent,
+            specialCase,
+            validators,
+            False,
+            contentType,
         )
-    newfile = Download(route.path)
-    return (newfile, True, originalcontent, specialCase)
 
+    printdev(
+        f"Info: File {route.path} did not exist in previous download or was explicitly removed (index.html, activities, ...) or was invalidated by update to navbar/theme: downloading..."
+    )
+    (newfile, validators, contentType) = Download(route.path)
+    return (newfile, True, originalcontent, specialCase, validators, False, contentType)
 
+
+# The same links of the navbar, footer, theme and fonts are on every page, so resolving a link is cached. Bounded, so a
+# large site can't grow the caches without end
+LINK_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=LINK_CACHE_SIZE)
 def ParseLink(link: str, wasDownloaded=True):
     changed = False
     query = ""
@@ -374,9 +1023,21 @@ def ParseLink(link: str, wasDownloaded=True):
 def AddRoute(route):
     if route.path.endswith("/") and len(route.path) > 1:
         route.path = route.path[:-1]
+    if imageVariantRegex.search(route.path):
+        # Made by MakeImageVariants next to the image, the server doesn't have it
+        return
+    AddLink(route.path, route.origpath, route.linkedfrom, route.query, route)
 
-    if route.path not in routesDone:
-        routesTodo.add(route)
+
+# AddRoute for a path that is already normalized, the Route is only made when the path is new
+def AddLink(path, origpath, linkedfrom, query, route=None):
+    with routesLock:
+        links = scannedLinks.get(linkedfrom)
+        if links is not None and path not in links:
+            links[path] = query
+        if path in routesDone or path in routesInProgress or path in routesTodo:
+            return
+        routesTodo.add(route or Route(path, origpath, linkedfrom, query))
 
 
 # headRemoveReferences = re.compile("<link rel=[\"'](?!stylesheet)(?!modulepreload)(?!icon)(?!apple-touch-icon)[^\"']+[\"'] [^>]+//dev2.sib-utrecht.nl[^>]+>")
@@ -416,256 +1077,728 @@ def combinePath(currentPath, path) -> str:
     # return str( / path))
 
 
-def FindNewRoutes(code, currentPath, wasDownloaded):
-    res = linkRegex.finditer(code)
-    for found in res:
-        path = found.group("url")
-        if path == "//cdn.jsdelivr.net":
-            continue
-        origpath = path
-        path, query = ParseLink(path, wasDownloaded)
-        if path is not None and len(found.group("patternMatch") or "") == 0:
-            path = combinePath(currentPath, path)
+# Returned: the normalized path that a parsed link on currentPath leads to, or None for the variants of images
+def ResolvePath(currentPath, path):
+    # An absolute path leads to the same route from every page
+    return ResolvePathFrom("/" if path.startswith("/") else currentPath, path)
 
-            AddRoute(Route(path, origpath, currentPath, query))
 
-    res = linkRegex2.finditer(code)
-    for found in res:
-        path = found.group("url")
-        if path == "//cdn.jsdelivr.net":
-            continue
-        origpath = path
-        path, query = ParseLink(path, wasDownloaded)
-        if path is not None and len(found.group("patternMatch") or "") == 0:
-            path = combinePath(currentPath, path)
+@lru_cache(maxsize=LINK_CACHE_SIZE)
+def ResolvePathFrom(currentPath, path):
+    path = combinePath(currentPath, path)
+    if path.endswith("/") and len(path) > 1:
+        path = path[:-1]
+    if imageVariantRegex.search(path):
+        # Made by MakeImageVariants next to the image, the server doesn't have it
+        return None
+    return path
 
-            AddRoute(Route(path, origpath, currentPath, query))
 
-    res = urlRegex.finditer(code)
-    for found in res:
-        path = found.group(2)
-        origpath = path
-        path, query = ParseLink(path, wasDownloaded)
+# Returned: what a parsed link is replaced with in the output
+@lru_cache(maxsize=LINK_CACHE_SIZE)
+def RewriteLink(path, query, appendix="/index.html"):
+    return GetNewUrl(path, appendix=appendix, use_orig=True) + query
+
+
+LINK_CACHES = [ParseLink, ResolvePathFrom, RewriteLink]
+
+
+# The Find functions return the parsed links of the match, so that ScanRoutes doesn't have to parse them again
+def FindNormalLink(found, currentPath, wasDownloaded):
+    path = found.group("url")
+    if path == "//cdn.jsdelivr.net":
+        return None
+    origpath = path
+    parsed = path, query = ParseLink(path, wasDownloaded)
+    if path is not None and len(found.group("patternMatch") or "") == 0:
+        path = ResolvePath(currentPath, path)
         if path is not None:
-            path = combinePath(currentPath, path)
+            AddLink(path, origpath, currentPath, query)
+    return [parsed]
+
 
-            AddRoute(Route(path, origpath, currentPath, query))
+def FindUrlLink(found, currentPath, wasDownloaded):
+    path = found.group(2)
+    origpath = path
+    parsed = path, query = ParseLink(path, wasDownloaded)
+    if path is not None:
+        path = ResolvePath(currentPath, path)
+        if path is not None:
+            AddLink(path, origpath, currentPath, query)
+    return [parsed]
 
-    res = srcsetRegex.finditer(code)
-    for found in res:
-        srcs = found.group(4).split(",")
-        for link in srcs:
-            path = link.split()[0]  # Important: same as below
-            origpath = path
-            path, query = ParseLink(path, wasDownloaded)
+
+def FindSrcset(found, currentPath, wasDownloaded):
+    srcs = found.group(4).split(",")
+    allParsed = []
+    for link in srcs:
+        path = link.split()[0]  # Important: same as below
+        origpath = path
+        parsed = path, query = ParseLink(path, wasDownloaded)
+        allParsed.append(parsed)
+        if path is not None:
+            path = ResolvePath(currentPath, path)
+
+            # routesTodo.add(Route(path, origpath, currentPath))
             if path is not None:
-                path = combinePath(currentPath, path)
+                AddLink(path, origpath, currentPath, query)
+    return allParsed
 
-                # routesTodo.add(Route(path, origpath, currentPath))
-                AddRoute(Route(path, origpath, currentPath, query))
 
-    res = stringRegex.finditer(code)
-    for found in res:
-        path = found.group(1).replace("\\/", "/")
-        if path == "/wp-admin/admin-ajax.php":
-            continue
+def FindString(found, currentPath, wasDownloaded):
+    path = found.group(1).replace("\\/", "/")
+    if path == "/wp-admin/admin-ajax.php":
+        return None
 
-        origpath = path
-        path, query = ParseLink(path, wasDownloaded)
+    origpath = path
+    path, query = ParseLink(path, wasDownloaded)
+    if path is not None:
+        path = ResolvePath(currentPath, path)
         if path is not None:
-            path = combinePath(currentPath, path)
+            AddLink(path, origpath, currentPath, query)
+    # The substitution parses the link with the escaped slashes, so this can't be reused
+    return None
+
+
+def FindNewRoutes(code, currentPath, wasDownloaded):
+    for found in linkRegex.finditer(code):
+        FindNormalLink(found, currentPath, wasDownloaded)
+
+    for found in linkRegex2.finditer(code):
+        FindNormalLink(found, currentPath, wasDownloaded)
+
+    for found in urlRegex.finditer(code):
+        FindUrlLink(found, currentPath, wasDownloaded)
 
-            AddRoute(Route(path, origpath, currentPath, query))
+    for found in srcsetRegex.finditer(code):
+        FindSrcset(found, currentPath, wasDownloaded)
+
+    for found in stringRegex.finditer(code):
+        FindString(found, currentPath, wasDownloaded)
 
 
 removedRelTypes = set()
 
+removeSecret = re.compile("/restricted/secret-[^/?#]+")
+removeWorkWebsite = re.compile(
+    "(dev[a-zA-Z0-9_-]{1,20}|edit|edit-unauth).sib-?utrecht.nl"
+)
 
-def SubstituteRoutes(code, currentPath):
-    def subNormalLink(match):
-        path, query = ParseLink(match.group("url"))
-        # print(f"SubNormalLink, full={match.group(6)}, path={path}, query={query}")
 
-        if path is None:
-            return match.group()
-        if match.group(3) is None:
-            appendix = "/index.html"
-            caret = ""
-        else:
-            appendix = ""
-            caret = "^"
-        return (
-            match.group(1)
-            + match.group(2)
-            + caret
-            + "="
-            + match.group(4)
-            + match.group(5)
-            + GetNewUrl(path, appendix=appendix, use_orig=True)
-            + query
-            + match.group(7)
-        )
+# parsed: the result of the Find function for this match, if there was one
+def SubNormalLink(match, parsed=None):
+    path, query = parsed[0] if parsed else ParseLink(match.group("url"))
+    # print(f"SubNormalLink, full={match.group(6)}, path={path}, query={query}")
 
-    def subUrlLink(match):
-        path, query = ParseLink(match.group(2))
-        if path is None:
-            return match.group()
-        closingDelimeter = match.group(1)
-        if closingDelimeter is None:
-            closingDelimeter = ""
-        return (
-            "url("
-            + closingDelimeter
-            + GetNewUrl(path, use_orig=True)
-            + query
-            + closingDelimeter
-            + ")"
-        )
+    if path is None:
+        return match.group()
+    if match.group(3) is None:
+        appendix = "/index.html"
+        caret = ""
+    else:
+        appendix = ""
+        caret = "^"
+    return (
+        match.group(1)
+        + match.group(2)
+        + caret
+        + "="
+        + match.group(4)
+        + match.group(5)
+        + RewriteLink(path, query, appendix)
+        + match.group(7)
+    )
 
-    def subSrcset(match):
-        output = []
-        srcs = match.group(4).split(",")
-        for src in srcs:
-            split = src.split()  # Important: don't give parameters to split in order to split on multiple consecutive whitespaces
-            if len(split) == 1:
-                # This can apparently happen in a carousel as a srcset without the second part for some reason
-                split += " "
 
-            path, query = ParseLink(split[0])
-            if path is None:
-                output.append(src + " " + " ".join(split[1:]))
-                continue
+def SubUrlLink(match, parsed=None):
+    path, query = parsed[0] if parsed else ParseLink(match.group(2))
+    if path is None:
+        return match.group()
+    closingDelimeter = match.group(1)
+    if closingDelimeter is None:
+        closingDelimeter = ""
+    return "url(" + closingDelimeter + RewriteLink(path, query) + closingDelimeter + ")"
 
-            output.append(
-                GetNewUrl(path, use_orig=True) + query + " " + " ".join(split[1:])
-            )
-        return "srcset=" + match.group(3) + ",".join(output) + match.group(5)
 
-    def subString(match):
-        path, query = ParseLink(match.group(1))
+def SubSrcset(match, parsed=None):
+    output = []
+    srcs = match.group(4).split(",")
+    for i, src in enumerate(srcs):
+        split = src.split()  # Important: don't give parameters to split in order to split on multiple consecutive whitespaces
+        if len(split) == 1:
+            # This can apparently happen in a carousel as a srcset without the second part for some reason
+            split += " "
+
+        path, query = parsed[i] if parsed else ParseLink(split[0])
         if path is None:
-            return match.group()
-        return '"' + GetNewUrl(path, use_orig=True) + query + '"'
-
-    code = linkRegex.sub(subNormalLink, code)
-    code = linkRegex2.sub(subNormalLink, code)
-    code = urlRegex.sub(subUrlLink, code)
-    code = srcsetRegex.sub(subSrcset, code)
-    code = stringRegex.sub(subString, code)
-
-    def onLinkRel(match):
-        relType = match.group("relType")
-        removedRelTypes.add(relType)
-
-        allowedRelTypes = {
-            "stylesheet",
-            "modulepreload",
-            "icon",
-            "apple-touch-icon",
-            "dns-prefetch",
-            "canonical",
-        }
-        disallowedRelTypes = {
-            "https://api.w.org/",
-            "dns-prefetch",
-            "EditURI",
-            "alternate",
-        }
-        if relType in allowedRelTypes:
-            return match.group()
+            output.append(src + " " + " ".join(split[1:]))
+            continue
 
-        if relType not in disallowedRelTypes:
-            print(
-                f"Add this rel type to allowedRelTypes or disallowedRelTypes: {relType}"
-            )
-            raise Exception(
-                f"Add this rel type to allowedRelTypes or disallowedRelTypes: {relType}"
-            )
+        output.append(RewriteLink(path, query) + " " + " ".join(split[1:]))
+    return "srcset=" + match.group(3) + ",".join(output) + match.group(5)
+
+
+def SubString(match, parsed=None):
+    path, query = ParseLink(match.group(1))
+    if path is None:
+        return match.group()
+    return '"' + RewriteLink(path, query) + '"'
+
+
+def OnLinkRel(match, parsed=None):
+    relType = match.group("relType")
+    removedRelTypes.add(relType)
+
+    allowedRelTypes = {
+        "stylesheet",
+        "modulepreload",
+        "icon",
+        "apple-touch-icon",
+        "dns-prefetch",
+        "canonical",
+    }
+    disallowedRelTypes = {
+        "https://api.w.org/",
+        "dns-prefetch",
+        "EditURI",
+        "alternate",
+    }
+    if relType in allowedRelTypes:
+        return match.group()
+
+    if relType not in disallowedRelTypes:
+        print(f"Add this rel type to allowedRelTypes or disallowedRelTypes: {relType}")
+        raise Exception(
+            f"Add this rel type to allowedRelTypes or disallowedRelTypes: {relType}"
+        )
+
+    # if relType == None:
+    #     return match.group()
+    return ""
 
-        # if relType == None:
-        #     return match.group()
-        return ""
+
+def SubstituteRoutes(code, currentPath):
+    code = linkRegex.sub(SubNormalLink, code)
+    code = linkRegex2.sub(SubNormalLink, code)
+    code = urlRegex.sub(SubUrlLink, code)
+    code = srcsetRegex.sub(SubSrcset, code)
+    code = stringRegex.sub(SubString, code)
 
     # code = headRemoveReferences.sub("", code)
-    code = headRemoveReferences.sub(onLinkRel, code)
+    code = headRemoveReferences.sub(OnLinkRel, code)
     return code
 
 
-def CheckCodeForLinks(code, currentPath, wasDownloaded):
-    removeSecret = re.compile("/restricted/secret-[^/?#]+")
-    code = removeSecret.sub("/restricted", code)
+# The link patterns in the order in which FindNewRoutes and SubstituteRoutes apply them, with what they do with a match
+# (None if a pattern only substitutes or only finds)
+LINK_PATTERNS = [
+    (linkRegex, FindNormalLink, SubNormalLink),
+    (linkRegex2, FindNormalLink, SubNormalLink),
+    (urlRegex, FindUrlLink, SubUrlLink),
+    (srcsetRegex, FindSrcset, SubSrcset),
+    (stringRegex, FindString, SubString),
+    (headRemoveReferences, None, OnLinkRel),
+]
+
+
+# Does the same as FindNewRoutes followed by SubstituteRoutes (if substitute is set), but goes over the document once:
+# the matches of all patterns are merged into one stream of links in document order, and every link is parsed once
+# for both finding and substituting it. The patterns are matched against the original document instead of the output
+# of the patterns before them, which only differs when a substitution makes a later pattern match across other links
+# (benchmark/run_benchmark.py compares both on the pages of the site and on random documents made of their links)
+# patterns: the part of LINK_PATTERNS that applies to this type of document
+def ScanRoutes(code, currentPath, wasDownloaded, substitute, patterns=LINK_PATTERNS):
+    links = []
+    for kind, (pattern, find, _) in enumerate(patterns):
+        for found in pattern.finditer(code):
+            parsed = None
+            if find is not None:
+                parsed = find(found, currentPath, wasDownloaded)
+            links.append((found.start(), found.end(), kind, found, parsed))
+
+    if not substitute:
+        return code
+
+    # Links that don't overlap with others are substituted directly. For overlapping links (like the href inside a
+    # <link> tag) the patterns are applied one after another like SubstituteRoutes does, to just those links
+    links.sort(key=lambda link: link[0])
+    output = []
+    pos = 0
+    i = 0
+    while i < len(links):
+        (start, end, kind, found, parsed) = links[i]
+        j = i + 1
+        while j < len(links) and links[j][0] < end:
+            end = max(end, links[j][1])
+            j += 1
+
+        output.append(code[pos:start])
+        if j == i + 1:
+            # Substituting parses as a downloaded file, so what was found for another file can't be reused
+            output.append(patterns[kind][2](found, parsed if wasDownloaded else None))
+        else:
+            overlapping = code[start:end]
+            for pattern, _, sub in patterns:
+                overlapping = pattern.sub(sub, overlapping)
+            output.append(overlapping)
+        pos = end
+        i = j
+    output.append(code[pos:])
+    return "".join(output)
+
+
+# Which links are rewritten in a document of each content type. Types that aren't here (images, fonts, pdfs, scripts)
+# are copied as they are, without being decoded or scanned
+HTML_PATTERNS = LINK_PATTERNS
+CSS_PATTERNS = [(urlRegex, FindUrlLink, SubUrlLink)]
+# Json only has links with escaped slashes, the same as the inline scripts in html
+JSON_PATTERNS = [(stringRegex, FindString, SubString)]
+PROCESSORS = {
+    "text/html": HTML_PATTERNS,
+    "application/xhtml+xml": HTML_PATTERNS,
+    "image/svg+xml": HTML_PATTERNS,
+    "application/xml": HTML_PATTERNS,
+    "text/xml": HTML_PATTERNS,
+    "text/plain": HTML_PATTERNS,
+    "text/css": CSS_PATTERNS,
+    "application/json": JSON_PATTERNS,
+}
 
-    FindNewRoutes(code, currentPath, wasDownloaded)
-    code = SubstituteRoutes(code, currentPath)
 
-    removeWorkWebsite = re.compile(
-        "(dev[a-zA-Z0-9_-]{1,20}|edit-(unauth)?).sib-?utrecht.nl"
+# Returned: the content type without parameters, from the Content-Type header or else from the extension
+def GetContentType(path, header=None):
+    if header is not None:
+        return header.split(";")[0].strip().lower()
+    # Pages don't have an extension
+    if "." not in path or path.endswith(".html"):
+        return "text/html"
+    (guessed, _) = mimetypes.guess_type(path)
+    return guessed or "application/octet-stream"
+
+
+# The header and footer (with the navbar) are the same on every page, apart from the markers of the current page below
+CHROME_PATTERNS = [
+    re.compile('<header class="wp-block-template-part">.*?</header>', re.DOTALL),
+    re.compile('<footer class="wp-block-template-part">.*?</footer>', re.DOTALL),
+]
+# The current menu item, the login link back to the page, the numbering of the layout blocks and lazy loading of
+# images (which depend on the content of the page before it) and submenu toggles linking to the page itself
+pageMarkerRegex = re.compile(
+    ' (?:aria-current="page"|loading="lazy"|fetchpriority="high")'
+    "|\\scurrent[-_](?:menu|page)[-_](?:item|ancestor|parent)(?=[\\s\"'])"
+    "|(redirect_to=)[^\"'&\\s<]*"
+    "|(is-layout-)\\d+"
+    '|(href=")[^"#]*(?=#")'
+)
+# The stylesheets and scripts of the theme and plugins, their ?ver= changes on an update
+assetRegex = re.compile(
+    "<link rel=[\"']stylesheet[\"'][^>]*>|<script[^>]*\\ssrc=[^>]*>"
+)
+
+
+def RemovePageMarkers(code):
+    return pageMarkerRegex.sub(
+        lambda found: found.group(1) or found.group(2) or found.group(3) or "", code
     )
-    code = removeWorkWebsite.sub("www.sib-utrecht.nl", code)
 
-    return code
+
+# The patches work on the tags of the header/footer, so only tags that changed are replaced
+def SplitTags(code):
+    return re.split("(?=<)", code)
+
+
+# Returned: (hash of the header/footer without page markers, the header/footer or None per pattern)
+def ChromeOf(code):
+    fragments = []
+    for pattern in CHROME_PATTERNS:
+        found = pattern.search(code)
+        fragments.append(found.group() if found is not None else None)
+    normalized = "\0".join(RemovePageMarkers(fragment or "") for fragment in fragments)
+    return (hashlib.sha256(normalized.encode("utf-8")).hexdigest(), fragments)
+
+
+# Compares the old and new version of the first up to date html file to see whether the navbar/theme changed
+def CheckChrome(oldCode, newCode, previous):
+    global htmlsDeleted, chromeChange
+    if "chrome" not in previous:
+        # The previous download didn't keep the hash of the header/footer yet, so compare the whole file
+        if oldCode != newCode:
+            print(
+                "Html file is different: navbar/theme changed. Now marking all html files for redownload."
+            )
+            htmlsDeleted = True
+        else:
+            printdev("HTML file is not different: navbar/theme did not change")
+        return
+
+    if assetRegex.findall(oldCode) != assetRegex.findall(newCode):
+        # An update of the theme or Wordpress can change anything in the pages, not just the header/footer
+        print(
+            "Stylesheets/scripts are different: theme changed. Now marking all html files for redownload."
+        )
+        htmlsDeleted = True
+        return
+
+    (oldHash, oldFragments) = ChromeOf(oldCode)
+    (newHash, newFragments) = ChromeOf(newCode)
+    if oldHash == newHash:
+        printdev("HTML file is not different: navbar/theme did not change")
+        return
+
+    # Per pattern the tags of the old and new header/footer and how to get from one to the other
+    patches = []
+    for oldFragment, newFragment in zip(oldFragments, newFragments):
+        if oldFragment is None and newFragment is None:
+            patches.append(None)
+            continue
+        if oldFragment is None or newFragment is None:
+            # A header/footer that appeared or disappeared can't be patched in
+            patches = None
+            break
+        oldTags = SplitTags(oldFragment)
+        newTags = SplitTags(newFragment)
+        opcodes = difflib.SequenceMatcher(
+            None, oldTags, newTags, autojunk=False
+        ).get_opcodes()
+        patches.append((oldTags, newTags, opcodes))
+    print(
+        "Header/footer is different: navbar changed. Now patching html files with the same header/footer, and redownloading the others."
+    )
+    chromeChange = (oldHash, newHash, patches)
+
+
+# Returned: the page with the new header/footer of chromeChange put in, or None if that can't be done safely
+def PatchChrome(code):
+    patches = chromeChange[2]
+    if patches is None:
+        return None
+    output = []
+    pos = 0
+    for pattern, patch in zip(CHROME_PATTERNS, patches):
+        if patch is None:
+            continue
+        (oldTags, newTags, opcodes) = patch
+        found = pattern.search(code, pos)
+        if found is None:
+            return None
+        tags = SplitTags(found.group())
+        if len(tags) != len(oldTags):
+            return None
+        patched = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                # These tags can contain the markers of this page, so they are kept
+                patched += tags[i1:i2]
+                continue
+            # The changed tags have to be exactly the same as on the checked page, and the new ones can't be marked
+            # as the current page of the checked page
+            if tags[i1:i2] != oldTags[i1:i2] or any(
+                pageMarkerRegex.search(newTag) for newTag in newTags[j1:j2]
+            ):
+                return None
+            patched += newTags[j1:j2]
+        output.append(code[pos : found.start()])
+        output.append("".join(patched))
+        pos = found.end()
+    output.append(code[pos:])
+    return "".join(output)
 
 
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 
+# The types of files that --precompress makes compressed versions of
+COMPRESSED_CONTENT_TYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+}
+# The extension of each compressed version, with how to make it at the highest compression level
+COMPRESSORS = [(".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+if brotli is not None:
+    COMPRESSORS.append((".br", lambda data: brotli.compress(data, quality=11)))
+
+
+# Writes the compressed versions of a file. If the file didn't change, the ones of the previous download are used
+def Precompress(route, changed):
+    location = GetNewUrl(route.path, for_writing=True)
+    previousLocation = GetNewUrl(route.path, for_writing=True, use_orig=True)
+    data = None
+    for extension, compress in COMPRESSORS:
+        if not changed and os.path.exists(previousLocation + extension):
+            CarryOver(previousLocation + extension, location + extension, route.path)
+            continue
+        if data is None:
+            fileWriter.Wait(location)
+            with open(location, "rb") as f:
+                data = f.read()
+        compressed = compress(data)
+        # The server just sends the file itself if there is no smaller version
+        if len(compressed) < len(data):
+            WriteFile(location + extension, compressed, route.path)
+            changedFiles.add(location + extension)
+
+
+# How each format of --image-variants is written, in the order in which browsers should prefer them
+# (a higher avif speed makes encoding over twice as fast for almost the same size)
+IMAGE_OPTIONS = {"avif": {"quality": 60, "speed": 8}, "webp": {"quality": 80}}
+VARIANT_CONTENT_TYPES = {"image/jpeg", "image/png"}
+unknownFormats = set(args.image_variants.split(",")) - set(IMAGE_OPTIONS) - {""}
+if len(unknownFormats) != 0:
+    print(
+        f"FATAL ERROR: unknown image formats for --image-variants: {', '.join(sorted(unknownFormats))}"
+    )
+    exit(-1)
+IMAGE_VARIANTS = [
+    format for format in IMAGE_OPTIONS if format in args.image_variants.split(",")
+]
+if len(IMAGE_VARIANTS) != 0 and Image is None:
+    print(f"{WARNING_TAG} Pillow is not installed, so no image variants are made")
+    IMAGE_VARIANTS = []
+if "avif" in IMAGE_VARIANTS:
+    Image.init()
+    if ".avif" not in Image.registered_extensions():
+        print(f"{WARNING_TAG} This version of Pillow can't write avif images")
+        IMAGE_VARIANTS.remove("avif")
+# Kept in the manifest for html pages and images, so they are made again when the formats or qualities change
+IMAGE_VARIANTS_SIGNATURE = ",".join(
+    ":".join([format] + [f"{k}={v}" for (k, v) in IMAGE_OPTIONS[format].items()])
+    for format in IMAGE_VARIANTS
+)
+
+
+# Writes the variants of a jpeg/png image next to it, as image.jpg.webp and so on. If the image didn't change, the ones
+# of the previous download are used. They are also written if they are bigger, the html may refer to them
+# Returned: the formats that were written, which the pages offer with <picture> (see AddPictureSources)
+# encodable: is it a jpeg/png according to the server, an image with another extension isn't encoded
+def MakeImageVariants(route, changed, encodable):
+    location = GetNewUrl(route.path, for_writing=True)
+    previousLocation = GetNewUrl(route.path, for_writing=True, use_orig=True)
+    image = None
+    written = []
+    for format in IMAGE_VARIANTS:
+        previousVariant = f"{previousLocation}.{format}"
+        if not changed and os.path.exists(previousVariant):
+            CarryOver(previousVariant, f"{location}.{format}", route.path)
+            written.append(format)
+            continue
+        try:
+            if not encodable:
+                raise ValueError(f"{route.path} isn't a jpeg or png image")
+            if image is None:
+                fileWriter.Wait(location)
+                image = Image.open(location)
+                # Palette and cmyk images can't be written as webp/avif
+                if image.mode not in ("RGB", "RGBA"):
+                    hasAlpha = "A" in image.getbands() or "transparency" in image.info
+                    image = image.convert("RGBA" if hasAlpha else "RGB")
+            image.save(f"{location}.{format}", format.upper(), **IMAGE_OPTIONS[format])
+        except Exception as e:
+            print(f"{WARNING_TAG} no {format} version of {route.path}: {e!r}")
+            # Pages that were written before may offer the previous one, which is better than none
+            if os.path.exists(previousVariant):
+                CarryOver(previousVariant, f"{location}.{format}", route.path)
+                written.append(format)
+            continue
+        AddToArchive(f"{location}.{format}")
+        changedFiles.add(f"{location}.{format}")
+        written.append(format)
+    return written
+
+
+imageVariantRegex = re.compile("\\.(jpe?g|png)\\.(webp|avif)$", re.IGNORECASE)
+pictureRegex = re.compile("<picture\\b.*?</picture>|<img\\b[^>]*>", re.DOTALL)
+imageAttributeRegex = re.compile('\\s(?P<name>src|srcset|sizes)="(?P<value>[^"]*)"')
+
+
+# The routes that MakeImageVariants is used for, and that pages can offer variants of
+def HasVariantExtension(path):
+    return path.lower().endswith((".jpg", ".jpeg", ".png"))
+
+
+# A route that failed is left out of the manifest. A jpeg/png image is kept as one without variants, so the pages that
+# show it can be finished (see AddPictureSources) instead of being made again in every download
+def RecordFailedRoute(path):
+    with routesLock:
+        manifest.pop(path, None)
+        if len(IMAGE_VARIANTS) != 0 and HasVariantExtension(path):
+            manifest[path] = {"path": path, "failed": True, "variants": []}
+
+
+# Returned: the path of the route of a rewritten image url, or None if it isn't a jpeg/png of the site
+def GetImagePath(url):
+    offlinePrefix = fileLocation + os.path.abspath(OUTPUT_DIR_OFFLINE)
+    if url.startswith(offlinePrefix):
+        url = url[len(offlinePrefix) :]
+    elif not url.startswith("/") or url.startswith("//"):
+        return None
+    if not HasVariantExtension(url):
+        return None
+    return url
+
+
+# Returned: the formats of which the image has a variant in this download, or None if that isn't known yet. Until it
+# is handled in this download, an image keeps the variants of the previous one (MakeImageVariants keeps those)
+def GetWrittenVariants(path):
+    entry = manifest.get(path)
+    if entry is None or "variants" not in entry:
+        entry = (previousManifest or {}).get(path)
+    if entry is None or "variants" not in entry:
+        return None
+    return entry["variants"]
+
+
+# Puts the images in <picture> elements with a <source> for every variant that all sizes of the image have
+# Returned: (code, are the variants of all images known), if not the page is made again in the next download
+def AddPictureSources(code):
+    complete = True
+
+    def OnImage(found):
+        tag = found.group()
+        if tag.startswith("<picture"):
+            return tag
+        attributes = {
+            attribute.group("name"): attribute.group("value")
+            for attribute in imageAttributeRegex.finditer(tag)
+        }
+        srcset = attributes.get("srcset") or attributes.get("src")
+        if srcset is None:
+            return tag
+        nonlocal complete
+        candidates = [src.split() for src in srcset.split(",") if src.strip() != ""]
+        formats = set(IMAGE_VARIANTS)
+        for candidate in candidates:
+            path = GetImagePath(candidate[0])
+            if path is None:
+                return tag
+            written = GetWrittenVariants(path)
+            if written is None:
+                complete = False
+                return tag
+            formats &= set(written)
+
+        sizes = f' sizes="{attributes["sizes"]}"' if "sizes" in attributes else ""
+        sources = []
+        for format in IMAGE_VARIANTS:
+            if format not in formats:
+                continue
+            variants = [
+                " ".join([f"{candidate[0]}.{format}"] + candidate[1:])
+                for candidate in candidates
+            ]
+            sources.append(
+                f'<source type="image/{format}" srcset="{",".join(variants)}"{sizes}>'
+            )
+        if len(sources) == 0:
+            return tag
+        return "<picture>" + "".join(sources) + tag + "</picture>"
+
+    return (pictureRegex.sub(OnImage, code), complete)
+
+
+# The hash of the file in the previous download, or None if it wasn't there
+def GetPreviousHash(route, previous):
+    if previous is None:
+        return None
+    if "hash" in previous:
+        return previous["hash"]
+
+    # The separate .time files of older downloads didn't have the hash, so it is computed once from the file
+    digest = hashlib.sha256()
+    try:
+        with open(GetNewUrl(route.path, for_writing=True, use_orig=True), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
 def HandleSingleFile(nextRoute):
+    start = perf_counter()
     try:
-        (fileBytes, wasDownloaded, originalcontent, specialCase) = Get(nextRoute)
-        routesDone.add(nextRoute.path)
+        (
+            fileBytes,
+            wasDownloaded,
+            originalcontent,
+            specialCase,
+            validators,
+            wasPatched,
+            contentType,
+        ) = Get(nextRoute)
+        with routesLock:
+            routesDone.add(nextRoute.path)
+        if wasDownloaded:
+            Count("routes_downloaded")
+        elif wasPatched:
+            Count("routes_patched")
+        else:
+            # Not modified on the server, or not asked because it didn't change since the previous download
+            Count("routes_reused")
         assert "restricted/secret-" not in nextRoute.path
+        previous = GetPreviousEntry(nextRoute)
+        chrome = None
+        streamed = isinstance(fileBytes, StreamedFile)
+        if contentType is None:
+            contentType = (previous or {}).get("type") or GetContentType(nextRoute.path)
+        patterns = PROCESSORS.get(contentType)
+        links = None
+        picturesComplete = True
         try:
-            if ".js" not in nextRoute.path:
+            if fileBytes is None:
+                # The previous download wasn't opened, the manifest has its links and header/footer
+                links = previous.get("links")
+                for path, query in (links or {}).items():
+                    AddLink(path, path, nextRoute.path, query)
+                chrome = previous.get("chrome")
+            elif patterns is not None and not streamed:
                 # we just assume all pages are utf-8 encoded
                 decoded = fileBytes.decode("utf-8")
 
-                removeSecret = re.compile("/restricted/secret-[^/?#]+")
                 decoded = removeSecret.sub("/restricted", decoded)
 
-                FindNewRoutes(decoded, nextRoute.path, wasDownloaded)
-                if wasDownloaded:
-                    decoded = SubstituteRoutes(decoded, nextRoute.path)
-
-                    removeWorkWebsite = re.compile(
-                        "(dev[a-zA-Z0-9_-]{1,20}|edit|edit-unauth).sib-?utrecht.nl"
+                with routesLock:
+                    scannedLinks[nextRoute.path] = {}
+                with Measure("links"):
+                    decoded = ScanRoutes(
+                        decoded,
+                        nextRoute.path,
+                        wasDownloaded,
+                        substitute=wasDownloaded,
+                        patterns=patterns,
                     )
+                with routesLock:
+                    links = scannedLinks.pop(nextRoute.path)
+                if wasDownloaded:
                     decoded = removeWorkWebsite.sub("www.sib-utrecht.nl", decoded)
+                    if contentType == "text/html" and len(IMAGE_VARIANTS) != 0:
+                        (decoded, picturesComplete) = AddPictureSources(decoded)
 
                     fileBytes = decoded.encode("utf-8")
                     if specialCase:
-                        if specialCase:
-                            if originalcontent != fileBytes:
-                                # with open("orig.html", "wb") as f:
-                                #     f.write(originalcontent)
-                                # with open("new.html", "wb") as f:
-                                #     f.write(fileBytes)
-                                print(
-                                    "Html file is different: navbar/theme changed. Now marking all html files for redownload."
-                                )
-                                # subprocess.run(
-                                #     [
-                                #         "find",
-                                #         "static/",
-                                #         "-maxdepth",
-                                #         "50",
-                                #         "-type",
-                                #         "f",
-                                #         "-name",
-                                #         "*.html",
-                                #         "-delete",
-                                #     ]
-                                # )
-                                global htmlsDeleted
-                                htmlsDeleted = True
-                            else:
-                                printdev(
-                                    "HTML file is not different: navbar/theme did not change"
-                                )
+                        CheckChrome(originalcontent.decode("utf-8"), decoded, previous)
+
+                if "." not in nextRoute.path or nextRoute.path.endswith(".html"):
+                    if not wasDownloaded and not wasPatched and previous is not None:
+                        chrome = previous.get("chrome")
+                    if chrome is None:
+                        (chrome, _) = ChromeOf(decoded)
 
         except UnicodeError:
             pass
-        if wasDownloaded:
-            WriteFile(GetNewUrl(nextRoute.path, for_writing=True), fileBytes)
+        if wasDownloaded or wasPatched:
+            # Streamed downloads are in the new generation already
+            if not streamed:
+                WriteFile(
+                    GetNewUrl(nextRoute.path, for_writing=True),
+                    fileBytes,
+                    nextRoute.path,
+                )
 
         else:
             dest = GetNewUrl(nextRoute.path, for_writing=True)
@@ -673,23 +1806,63 @@ def HandleSingleFile(nextRoute):
             origPath = Path(GetNewUrl(nextRoute.path, for_writing=True, use_orig=True))
             destPath = Path(dest)
 
-            destPath.parent.mkdir(parents=True, exist_ok=True)
-            origPath.rename(destPath)
-
-        if wasDownloaded and originalcontent != fileBytes:
-            with open(GetLocationOfTimestampFromURL(nextRoute.path, False), "w") as f:
-                f.write(time_now)
+            CarryOver(origPath, destPath, nextRoute.path)
+
+        entry = {"path": nextRoute.path, "query": nextRoute.query, "type": contentType}
+        newHash = None
+        if streamed:
+            newHash = fileBytes.digest
+        elif wasDownloaded or wasPatched:
+            newHash = hashlib.sha256(fileBytes).hexdigest()
+        if newHash is not None and newHash != GetPreviousHash(nextRoute, previous):
+            entry["time"] = time_now
+            entry["hash"] = newHash
         else:
-            origPath = Path(
-                GetLocationOfTimestampFromURL(nextRoute.path, use_orig=True),
-            )
-            destPath = Path(
-                GetLocationOfTimestampFromURL(nextRoute.path, use_orig=False),
+            entry["time"] = previous["time"]
+            entry["hash"] = (
+                previous.get("hash") or newHash or hashlib.sha256(fileBytes).hexdigest()
             )
-
-            origPath.rename(destPath)
+            if not wasDownloaded and len(validators) == 0:
+                validators = previous.get("validators", {})
+        if len(validators) != 0:
+            entry["validators"] = validators
+        if chrome is not None:
+            entry["chrome"] = chrome
+        if links is not None:
+            entry["links"] = links
+        if nextRoute.path in listingPages:
+            freshness = GetFreshnessKey(nextRoute.path, links)
+            if freshness is None:
+                # Asked with --changed, kept until the next download that asks the events
+                freshness = (previous or {}).get("freshness")
+            if freshness is not None:
+                entry["freshness"] = freshness
+        if IMAGE_VARIANTS_SIGNATURE != "" and (
+            contentType == "text/html" or HasVariantExtension(nextRoute.path)
+        ):
+            # A page with images that had no variants yet is made again in the next download
+            if picturesComplete:
+                entry["images"] = IMAGE_VARIANTS_SIGNATURE
+        manifest[nextRoute.path] = entry
+
+        changed = entry["hash"] != GetPreviousHash(nextRoute, previous)
+        if changed:
+            changedFiles.add(GetNewUrl(nextRoute.path, for_writing=True))
+        if args.precompress and contentType in COMPRESSED_CONTENT_TYPES:
+            with Measure("precompress"):
+                Precompress(nextRoute, changed)
+        if HasVariantExtension(nextRoute.path) and len(IMAGE_VARIANTS) != 0:
+            with Measure("image_variants"):
+                entry["variants"] = MakeImageVariants(
+                    nextRoute,
+                    changed=changed
+                    or (previous or {}).get("images", "") != IMAGE_VARIANTS_SIGNATURE,
+                    encodable=contentType in VARIANT_CONTENT_TYPES,
+                )
 
     except Exception as e:
+        Count("routes_failed")
+        RecordFailedRoute(nextRoute.path)
         if args.verbose:
             print("Something went wrong while working on path ", nextRoute)
             print(repr(e))
@@ -703,121 +1876,725 @@ def HandleSingleFile(nextRoute):
             #     f"\n{WARNING_TAG} something went wrong while working on path {nextRoute}"
             # )
             # print(repr(e))
+    finally:
+        with metricsLock:
+            routeSeconds.append((perf_counter() - start, nextRoute.path))
+        with routesLock:
+            routesInProgress.discard(nextRoute.path)
+        if nextRoute.path == navbarProbePath:
+            navbarChecked.set()
 
 
 time_now = datetime.now(timezone.utc).strftime(TIME_FORMAT)
 
 
 def DownloadEverything():
-    while len(routesTodo) != 0:
-        nextRoute = routesTodo.pop()
-        if nextRoute.path not in routesDone:
-            HandleSingleFile(nextRoute)
+    # With --concurrency 1 this handles the routes one after another, like before
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        inFlight = set()
+        while True:
+            with routesLock:
+                while len(routesTodo) != 0 and len(inFlight) < args.concurrency:
+                    nextRoute = routesTodo.pop()
+                    if (
+                        nextRoute.path in routesDone
+                        or nextRoute.path in routesInProgress
+                    ):
+                        continue
+                    routesInProgress.add(nextRoute.path)
+                    inFlight.add(executor.submit(HandleSingleFile, nextRoute))
+
+            if len(inFlight) == 0:
+                break
+
+            done, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Re-raises the exit() of a worker in --verbose mode
+                future.result()
+
+    fileWriter.Flush()
 
 
 MODIFICATION_TIMES = {}
+# The modification dates of the previous download are kept in the output folder, with the latest modification date of
+# the media and pages in it as the cursor. Then only what was modified after the cursor has to be asked from Wordpress
+MODIFICATION_TIMES_FILE = ".modification-times.json"
+modificationCursor = None
+# When all modification dates were asked the previous time. Only those listings leave out pages that were trashed or
+# unpublished, so the table is replaced by one every --full-sync-days instead of only growing
+fullListingTime = None
+# Asking a bit before the cursor also gets the pages that were being saved while the previous listing was made
+CURSOR_MARGIN = timedelta(minutes=5)
+
+
+# Returned: were the modification dates of the previous download loaded?
+def LoadModificationTimes():
+    global MODIFICATION_TIMES, modificationCursor, fullListingTime
+    try:
+        with open(Path(OUTPUT_DIR) / MODIFICATION_TIMES_FILE) as f:
+            stored = json.load(f)
+    except (IOError, ValueError):
+        printdev(
+            f"{WARNING_TAG} No modification dates in {OUTPUT_DIR}, getting all of them"
+        )
+        return False
+    if stored["cursor"] is None:
+        return False
+    MODIFICATION_TIMES = {
+        path: datetime.fromisoformat(modified)
+        for (path, modified) in stored["times"].items()
+    }
+    modificationCursor = datetime.fromisoformat(stored["cursor"])
+    # Not in the files of older downloads
+    if stored.get("full_listing") is not None:
+        fullListingTime = datetime.fromisoformat(stored["full_listing"])
+    return True
 
 
-def GetModificationDates(path):
-    global MODIFICATION_TIMES
-    page_num = 1
-    while True:
-        r = requests.get(
-            f"{website}{path}?page={page_num}&per_page=100", auth=auth, params=params
-        )  # The limit for per_page is 100
-        if r.status_code == 400:
-            # We reached the end
-            break
+# Returned: should all modification dates be asked again, instead of the ones after the cursor?
+def IsFullListingDue():
+    if fullListingTime is None:
+        return True
+    return datetime.now(timezone.utc) - fullListingTime >= timedelta(
+        days=args.full_sync_days
+    )
 
-        if r.status_code > 300:
-            raise Exception(
-                f"Error: status code {r.status_code} while fetching {website}{path}"
-            )
 
-        json = r.json()
-        for page in json:
-            modified_time = datetime.strptime(page["modified"], TIME_FORMAT).replace(
-                tzinfo=timezone.utc
-            )  # The site's time is in utc
-            try:
-                links = [page["source_url"]]
-                for size in page["media_details"]["sizes"]:
-                    links.append(page["media_details"]["sizes"][size]["source_url"])
-            except:
-                links = [page["link"]]
-            for link in links:
-                if not link.startswith(website) and not link.startswith(
-                    alternate_website
-                ):
-                    # I am not sure when this triggers but it does not happen right now
-                    if args.verbose:
-                        raise Exception(
-                            "Error: linked page '" + link + "' is not a SIB-page!"
-                        )
-                    else:
-                        print(f"{WARNING_TAG} linked page '{link}' is not a SIB page")
-                        continue
-                currentpath = (
-                    link[len(website) :]
-                    if link.startswith(website)
-                    else link[len(alternate_website) :]
-                )
-                if currentpath.endswith("/") and len(currentpath) > 1:
-                    currentpath = currentpath[:-1]
+def WriteModificationTimes(location):
+    stored = {
+        "cursor": (
+            modificationCursor.isoformat() if modificationCursor is not None else None
+        ),
+        "full_listing": (
+            fullListingTime.isoformat() if fullListingTime is not None else None
+        ),
+        "times": {
+            path: modified.isoformat()
+            for (path, modified) in sorted(MODIFICATION_TIMES.items())
+        },
+    }
+    with open(location, "w") as f:
+        json.dump(stored, f, separators=(",", ":"))
+
+
+# Only the fields that are read below are requested, without them Wordpress also sends the rendered content of every page
+MODIFICATION_FIELDS = "modified,link,source_url,media_details.sizes"
+
+
+# Returned: the response for one page of the listing, or None if it is past the last page
+# modifiedAfter: only list what was modified after this time, or None for everything
+def GetModificationDatesPage(path, page_num, modifiedAfter=None):
+    pageParams = {
+        **params,
+        "page": page_num,
+        "per_page": 100,  # The limit for per_page is 100
+        "_fields": MODIFICATION_FIELDS,
+    }
+    if modifiedAfter is not None:
+        pageParams["modified_after"] = modifiedAfter
+    r = Request(f"{website}{path}", auth=auth, params=pageParams)
+    if r.status_code == 400:
+        # We reached the end
+        return None
+
+    if r.status_code > 300:
+        raise Exception(
+            f"Error: status code {r.status_code} while fetching {website}{path}"
+        )
+    return r
 
-                MODIFICATION_TIMES[currentpath] = modified_time
 
-        page_num += 1
+def AddModificationDates(pages):
+    global MODIFICATION_TIMES, modificationCursor
+    for page in pages:
+        modified_time = datetime.strptime(page["modified"], TIME_FORMAT).replace(
+            tzinfo=timezone.utc
+        )  # The site's time is in utc
+        if modificationCursor is None or modified_time > modificationCursor:
+            modificationCursor = modified_time
+        try:
+            links = [page["source_url"]]
+            for size in page["media_details"]["sizes"]:
+                links.append(page["media_details"]["sizes"][size]["source_url"])
+        except:
+            links = [page["link"]]
+        for link in links:
+            if not link.startswith(website) and not link.startswith(alternate_website):
+                # I am not sure when this triggers but it does not happen right now
+                if args.verbose:
+                    raise Exception(
+                        "Error: linked page '" + link + "' is not a SIB-page!"
+                    )
+                else:
+                    print(f"{WARNING_TAG} linked page '{link}' is not a SIB page")
+                    continue
+            currentpath = (
+                link[len(website) :]
+                if link.startswith(website)
+                else link[len(alternate_website) :]
+            )
+            if currentpath.endswith("/") and len(currentpath) > 1:
+                currentpath = currentpath[:-1]
+
+            MODIFICATION_TIMES[currentpath] = modified_time
+
+
+def GetModificationDates(path, modifiedAfter=None):
+    r = GetModificationDatesPage(path, 1, modifiedAfter)
+    if r is None:
+        return
+    AddModificationDates(r.json())
+
+    if "X-WP-TotalPages" not in r.headers:
+        # Without the number of pages, keep asking for the next one until we are past the end
+        page_num = 2
+        while True:
+            r = GetModificationDatesPage(path, page_num, modifiedAfter)
+            if r is None:
+                break
+            AddModificationDates(r.json())
+            page_num += 1
+        return
+
+    # The other pages are fetched in parallel, but added to MODIFICATION_TIMES by this thread only
+    totalPages = int(r.headers["X-WP-TotalPages"])
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for r in executor.map(
+            lambda page_num: GetModificationDatesPage(path, page_num, modifiedAfter),
+            range(2, totalPages + 1),
+        ):
+            if r is not None:
+                AddModificationDates(r.json())
+
+
+# The sha256 of the ids and modification dates of all events, None if the events weren't asked (with --changed)
+eventsDigest = None
 
 
 def GetModificationDatesForEvents():
-    global MODIFICATION_TIMES
-    r = requests.get("https://api2.sib-utrecht.nl/v2/events")
+    global MODIFICATION_TIMES, eventsDigest
+    r = requests.get(events_api)
 
     json = r.json()
-    for page in json["data"]["events"]:
+    digest = hashlib.sha256()
+    for page in sorted(json["data"]["events"], key=lambda page: str(page["id"])):
         modified_time = datetime.fromisoformat(page["$.modified"])
         link = f"/activities/{page['id']}"
         MODIFICATION_TIMES[link] = modified_time
+        digest.update(f"{page['id']} {page['$.modified']}\n".encode())
+    eventsDigest = digest.hexdigest()
+
+
+# Returned: what the content of a page in listingPages depends on, or None if the events weren't asked. That is the
+# events (a new, changed or removed one), the newest modification date of the page and the pages it links to, and the
+# date, because what is upcoming changes every day
+# links: the links in the page, from the manifest
+def GetFreshnessKey(path, links):
+    if eventsDigest is None:
+        return None
+    dates = [
+        MODIFICATION_TIMES[link] for link in links or {} if link in MODIFICATION_TIMES
+    ]
+    if path in MODIFICATION_TIMES:
+        dates.append(MODIFICATION_TIMES[path])
+    newest = max(dates).isoformat() if len(dates) != 0 else ""
+    today = datetime.now(tz).date().isoformat()
+    return f"{eventsDigest[:16]} {newest} {today}"
+
+
+def GetGenerations():
+    if not GENERATIONS_DIR.is_dir():
+        return []
+    return sorted(int(p.name) for p in GENERATIONS_DIR.iterdir() if p.name.isdigit())
+
+
+def GetGenerationDir(generation):
+    return GENERATIONS_DIR / f"{generation:06d}"
+
+
+# The generation OUTPUT_DIR points to, or None if nothing is served yet
+def GetLiveGeneration():
+    if not os.path.islink(OUTPUT_DIR):
+        return None
+    return int(Path(os.readlink(OUTPUT_DIR)).name)
+
+
+def SwitchGeneration(generation):
+    # Replacing the symlink by renaming a new one over it is atomic, so the served folder is never missing
+    switch = Path(f"{OUTPUT_DIR}.switch")
+    if os.path.lexists(switch):
+        switch.unlink()
+    os.symlink(GetGenerationDir(generation), switch)
+    os.replace(switch, OUTPUT_DIR)
+
+
+def DeleteGenerations(generations):
+    for generation in generations:
+        printdev(f"Deleting old generation {GetGenerationDir(generation)}")
+        shutil.rmtree(GetGenerationDir(generation), ignore_errors=True)
+
+
+def Rollback():
+    live = GetLiveGeneration()
+    complete = [
+        generation
+        for generation in GetGenerations()
+        if (live is None or generation < live)
+        and (GetGenerationDir(generation) / MANIFEST_FILE).exists()
+    ]
+    if len(complete) == 0:
+        print(f"FATAL ERROR: there is no generation before {live} to roll back to")
+        exit(-1)
+    SwitchGeneration(complete[-1])
+    print(f"Rolled back {OUTPUT_DIR} from generation {live} to {complete[-1]}")
+
+
+generationCleanup = None
+# The generation that was served when this download started, that .changes.json compares against
+previousGeneration = None
+
+
+def SetupGeneration():
+    global BUILD_DIR, generationCleanup, previousGeneration
+    if os.path.isdir(OUTPUT_DIR) and not os.path.islink(OUTPUT_DIR):
+        # A download from before there were generations, it becomes the first one
+        GENERATIONS_DIR.mkdir(exist_ok=True)
+        os.rename(OUTPUT_DIR, GetGenerationDir(0))
+        SwitchGeneration(0)
+
+    generations = GetGenerations()
+    live = GetLiveGeneration()
+    previousGeneration = live
+    old = [generation for generation in generations if generation != live]
+    old = old[: max(0, len(old) - (args.keep_generations - 1))]
+    # Old generations are deleted while the site is downloaded, the live one is still needed to carry over files
+    generationCleanup = threading.Thread(target=DeleteGenerations, args=(old,))
+    generationCleanup.start()
+
+    generation = generations[-1] + 1 if len(generations) != 0 else 0
+    BUILD_DIR = str(GetGenerationDir(generation))
+    Path(BUILD_DIR).mkdir(parents=True)
+    return generation
+
+
+# With --offline-archive the files are also packed into an archive while they are written. The links in it are
+# relative to the file instead of the absolute file:// urls of the cache folder, that only work on the machine that
+# made them
+TAR_MODES = {".tar.gz": "w:gz", ".tgz": "w:gz", ".tar.xz": "w:xz", ".tar.zst": "w|"}
+if args.offline_archive is not None:
+    if not args.offline_archive.endswith((".zip",) + tuple(TAR_MODES)):
+        print(
+            f"FATAL ERROR: --offline-archive must end with .zip, {', '.join(TAR_MODES)}"
+        )
+        exit(-1)
+    if args.offline_archive.endswith(".tar.zst") and zstandard is None:
+        print("FATAL ERROR: zstandard is not installed, it is needed for .tar.zst")
+        exit(-1)
+
+
+class OfflineArchive:
+    def __init__(self, location, generation):
+        self.location = location
+        # Written under another name first, so the previous archive stays complete until this one is
+        self.partial = f"{location}.part"
+        self.lock = threading.Lock()
+        # The links in the scripts have escaped slashes
+        prefix = f"{fileLocation}{os.path.abspath(OUTPUT_DIR_OFFLINE)}"
+        self.linkRegex = re.compile(
+            re.escape(prefix).encode() + b"(\\\\?/)([^\"'\\s(),<>?#]*)"
+        )
+        self.stream = None
+        # The zip of the previous download, of which the members of unchanged files are used as they are
+        self.previous = None
+        if location.endswith(".zip"):
+            self.archive = zipfile.ZipFile(self.partial, "w")
+            # Tells the next download which generation this archive has
+            self.archive.comment = f"generation {generation}".encode()
+            if previousGeneration is not None and zipfile.is_zipfile(location):
+                previous = zipfile.ZipFile(location)
+                if previous.comment == f"generation {previousGeneration}".encode():
+                    self.previous = previous
+                else:
+                    previous.close()
+        elif location.endswith(".tar.zst"):
+            self.stream = zstandard.ZstdCompressor().stream_writer(
+                open(self.partial, "wb")
+            )
+            self.archive = tarfile.open(fileobj=self.stream, mode="w|")
+        else:
+            mode = next(m for (e, m) in TAR_MODES.items() if location.endswith(e))
+            self.archive = tarfile.open(self.partial, mode)
+
+    def RelativeLinks(self, data, member):
+        directory = posixpath.dirname(member) or "."
+
+        def OnLink(found):
+            path = found.group(2).decode().replace("\\/", "/")
+            relative = posixpath.relpath(path, directory)
+            if found.group(1) != b"/":
+                relative = relative.replace("/", "\\/")
+            return relative.encode()
+
+        return self.linkRegex.sub(OnLink, data)
+
+    # location: the file in the new generation, with its content if that is in memory already
+    # unchanged: the file is the same as in the previous generation
+    def Add(self, location, data=None, unchanged=False):
+        member = Path(location).relative_to(BUILD_DIR).as_posix()
+        # The compressed versions are only for servers
+        if any(member.endswith(extension) for (extension, _) in COMPRESSORS):
+            return
+        contentType = GetContentType(member)
+        if (
+            unchanged
+            and self.previous is not None
+            and member in self.previous.NameToInfo
+        ):
+            data = self.previous.read(member)
+            Count("archive_members_reused")
+        elif contentType in PROCESSORS:
+            if data is None:
+                with open(location, "rb") as f:
+                    data = f.read()
+            data = self.RelativeLinks(data, member)
+
+        Count("archive_members")
+        with Measure("archive"), self.lock:
+            if isinstance(self.archive, zipfile.ZipFile):
+                compression = zipfile.ZIP_STORED
+                if contentType in COMPRESSED_CONTENT_TYPES:
+                    compression = zipfile.ZIP_DEFLATED
+                if data is None:
+                    self.archive.write(location, member, compression)
+                else:
+                    self.archive.writestr(member, data, compression)
+            elif data is None:
+                self.archive.add(location, member)
+            else:
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                info.mtime = int(datetime.now().timestamp())
+                self.archive.addfile(info, io.BytesIO(data))
+
+    def Close(self):
+        self.archive.close()
+        if self.stream is not None:
+            self.stream.close()
+        if self.previous is not None:
+            self.previous.close()
+        os.replace(self.partial, self.location)
+
+
+offlineArchive = None
+
+
+def SetupOfflineArchive(generation):
+    global offlineArchive
+    if args.offline_archive is None:
+        return
+    offlineArchive = OfflineArchive(args.offline_archive, generation)
+
+
+def AddToArchive(location, data=None, unchanged=False):
+    if offlineArchive is not None:
+        offlineArchive.Add(location, data, unchanged)
+
+
+# The files that were added, changed and removed compared to the previous generation, with the paths to invalidate in
+# the CDN, so the upload scripts only have to send those instead of comparing the checksums of every file
+CHANGES_FILE = ".changes.json"
+# Above this, invalidating everything is cheaper (CloudFront charges per path) and stays below its limit
+MAX_INVALIDATION_PATHS = 1000
+
+
+def ListFiles(directory):
+    files = set()
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files.add(Path(root, name).relative_to(directory).as_posix())
+    return files - {MANIFEST_FILE, MODIFICATION_TIMES_FILE, CHANGES_FILE}
+
+
+def GetInvalidationPaths(files):
+    paths = set()
+    for file in files:
+        # The compressed versions are served under the url of the file itself
+        if any(file.endswith(extension) for (extension, _) in COMPRESSORS):
+            continue
+        paths.add("/" + file)
+        if file == "index.html" or file.endswith("/index.html"):
+            directory = "/" + file[: -len("index.html")]
+            paths.add(directory)
+            if directory != "/":
+                paths.add(directory[:-1])
+    if len(paths) > MAX_INVALIDATION_PATHS:
+        return ["/*"]
+    return sorted(quote(path) for path in paths)
+
+
+# Returned: the id in the .changes.json of a generation, or None if it doesn't have one
+def GetGenerationId(generation):
+    try:
+        with open(GetGenerationDir(generation) / CHANGES_FILE) as f:
+            return json.load(f).get("id")
+    except (IOError, ValueError):
+        return None
+
+
+def WriteChanges(location, generation):
+    files = ListFiles(BUILD_DIR)
+    previousFiles = set()
+    previousId = None
+    if previousGeneration is not None:
+        previousFiles = ListFiles(GetGenerationDir(previousGeneration))
+        previousId = GetGenerationId(previousGeneration)
+    changed = {
+        Path(location).relative_to(BUILD_DIR).as_posix() for location in changedFiles
+    }
+    changes = {
+        "generation": generation,
+        "previous": previousGeneration,
+        # The numbers can be used again (when the folder with the generations is lost or not pushed), the ids can't
+        "id": f"{generation}-{time_now}",
+        "previous_id": previousId,
+        "added": sorted(files - previousFiles),
+        "changed": sorted(changed & previousFiles & files),
+        "removed": sorted(previousFiles - files),
+    }
+    changes["invalidate"] = GetInvalidationPaths(
+        changes["added"] + changes["changed"] + changes["removed"]
+    )
+    with open(location, "w") as f:
+        json.dump(changes, f, indent=1)
+    print(
+        f"{len(changes['added'])} files added, {len(changes['changed'])} changed and {len(changes['removed'])} removed"
+    )
+
+
+changedParameterRegex = re.compile('[?&]changed=([^&\\s"]+)')
+
+
+# Returned: the paths of the routes given with --changed and --changed-file
+def ReadChangedPaths():
+    links = list(args.changed)
+    if args.changed_file is not None:
+        with open(args.changed_file) as f:
+            for line in f:
+                parameters = changedParameterRegex.findall(line)
+                if len(parameters) != 0:
+                    links += [unquote(parameter) for parameter in parameters]
+                elif line.strip().startswith(("/", "http")):
+                    links.append(line.strip())
+
+    paths = set()
+    for link in links:
+        (path, _) = ParseLink(link)
+        if path is None or not path.startswith("/"):
+            print(f"{WARNING_TAG} '{link}' is not a page of the site, ignoring it")
+            continue
+        if path.endswith("/") and len(path) > 1:
+            path = path[:-1]
+        paths.add(path)
+    return paths
+
+
+# Returned: are only the --changed routes downloaded again?
+def SetupChangedRoutes():
+    global changedRoutes
+    changed = ReadChangedPaths()
+    if len(changed) == 0:
+        return False
+    if previousManifest is None:
+        print(
+            f"{WARNING_TAG} The previous download has no manifest with the links between pages, downloading everything"
+        )
+        return False
+
+    # Links that every page with a header/footer has are in the header/footer, the navbar check updates those
+    everywhere = None
+    for entry in previousManifest.values():
+        if "chrome" in entry and "links" in entry:
+            links = set(entry["links"])
+            everywhere = links if everywhere is None else everywhere & links
+
+    # The reverse of the other links in the manifest: which pages link to (or embed) a route
+    linkedFrom = {}
+    for entry in previousManifest.values():
+        for link in entry.get("links", {}):
+            if everywhere is None or link not in everywhere:
+                linkedFrom.setdefault(link, set()).add(entry["path"])
+
+    changedRoutes = set(changed)
+    for path in changed:
+        changedRoutes |= linkedFrom.get(path, set())
+        # Pages that are new aren't linked from anywhere yet
+        AddRoute(Route(path, path, "--changed"))
+    print(
+        f"Downloading {len(changed)} changed routes and {len(changedRoutes) - len(changed)} routes that link to them again"
+    )
+    return True
 
 
 def SetupUpdate():
-    TEMP_DIR.mkdir(exist_ok=True)
+    global MODIFICATION_TIMES, modificationCursor, fullListingTime
+    LoadManifest()
+    if SetupChangedRoutes():
+        # The modification dates are kept for the next full download
+        LoadModificationTimes()
+        return
+
+    modifiedAfter = None
+    if not args.full_sync and LoadModificationTimes() and not IsFullListingDue():
+        modifiedAfter = (modificationCursor - CURSOR_MARGIN).strftime(TIME_FORMAT)
+        printdev(f"Only getting modification dates after {modifiedAfter}")
+    else:
+        # Replaced instead of added to, pages that aren't listed anymore are downloaded again (and fail with a 404)
+        MODIFICATION_TIMES = {}
+        modificationCursor = None
+        fullListingTime = datetime.now(timezone.utc)
 
     print("Getting modification dates of files...")
+    # The events API can't filter on the modification date, but there are few events
     GetModificationDatesForEvents()
 
     printdev("Getting modification dates of media...")
-    GetModificationDates("/wp-json/wp/v2/media")
+    GetModificationDates("/wp-json/wp/v2/media", modifiedAfter)
 
     printdev("Getting modification dates of pages...")
-    GetModificationDates("/wp-json/wp/v2/pages")
+    GetModificationDates("/wp-json/wp/v2/pages", modifiedAfter)
+
+
+def CleanupUpdate(generation):
+    WriteModificationTimes(Path(BUILD_DIR) / MODIFICATION_TIMES_FILE)
+    WriteManifest(Path(BUILD_DIR) / MANIFEST_FILE)
+    WriteChanges(Path(BUILD_DIR) / CHANGES_FILE, generation)
+    if offlineArchive is not None:
+        offlineArchive.Close()
+    SwitchGeneration(generation)
+    printdev(f"Now serving generation {BUILD_DIR}")
+    generationCleanup.join()
+    if args.keep_generations == 0 and previousGeneration is not None:
+        # It was only kept to carry over files from
+        DeleteGenerations([previousGeneration])
+    DeleteUnusedBlobs()
+
+
+SLOWEST_ROUTES = 10
+METRICS_PREFIX = "sib_cache"
+
+
+# Returned: the nearest-rank percentiles and the maximum of the seconds of the (seconds, path) samples
+def GetPercentiles(samples):
+    seconds = sorted(sample for (sample, _) in samples)
+    if len(seconds) == 0:
+        return {}
+    percentiles = {}
+    for percentile in (50, 90, 99):
+        rank = max(0, (len(seconds) * percentile + 99) // 100 - 1)
+        percentiles[f"p{percentile}"] = round(seconds[rank], 4)
+    percentiles["max"] = round(seconds[-1], 4)
+    return percentiles
+
+
+def GetReport(seconds):
+    with metricsLock:
+        return {
+            "started": time_now,
+            "seconds": round(seconds, 3),
+            "phases": {
+                phase: round(t, 3) for (phase, t) in sorted(phaseSeconds.items())
+            },
+            "counts": dict(
+                sorted(counts.items()),
+                routes=len(routeSeconds),
+                requests=numdownloaded,
+                not_modified=numnotmodified,
+                files_changed=len(changedFiles),
+                link_cache_hits=sum(f.cache_info().hits for f in LINK_CACHES),
+                link_cache_misses=sum(f.cache_info().misses for f in LINK_CACHES),
+            ),
+            "route_seconds": GetPercentiles(routeSeconds),
+            "download_seconds": GetPercentiles(downloadSeconds),
+            "slowest": [
+                {"path": path, "seconds": round(t, 4)}
+                for (t, path) in sorted(routeSeconds, reverse=True)[:SLOWEST_ROUTES]
+            ],
+        }
 
 
-def CleanupUpdate():
-    if USE_FILE_LOCATION:
-        output_dir = OUTPUT_DIR_OFFLINE
-    else:
-        output_dir = OUTPUT_DIR_HTTP
+def WriteReport(location, report):
+    with open(location, "w") as f:
+        json.dump(report, f, indent=1)
 
-    output_dir = Path(output_dir)
-    shutil.rmtree(output_dir, ignore_errors=True)
 
-    TEMP_DIR.rename(output_dir)
+def WritePrometheus(location, report):
+    lines = []
 
+    def AddMetric(name, help, samples):
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {help}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+        for labels, value in samples:
+            lines.append(f"{METRICS_PREFIX}_{name}{labels} {value}")
 
-start_stopwatch = perf_counter()
-print(f"Starting the scraping at {datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S %Z%z')}")
-SetupUpdate()
-print("Downloaded all modification dates. Now downloading the pages.")
-DownloadEverything()
-printdev("Finished downloading all pages. Now cleaning up")
-CleanupUpdate()
-end_stopwatch = perf_counter()
-time = str(end_stopwatch - start_stopwatch)
-pos = time.find(".")
-if pos != -1:
-    time = time[:pos]
-print(f"Finished downloading {numdownloaded} files in {time} seconds")
+    AddMetric("run_seconds", "Duration of the last download", [("", report["seconds"])])
+    AddMetric(
+        "last_run_timestamp_seconds",
+        "When the last download finished",
+        [("", int(datetime.now(timezone.utc).timestamp()))],
+    )
+    AddMetric(
+        "phase_seconds",
+        "Seconds spent in each phase of the last download, summed over the threads",
+        [(f'{{phase="{phase}"}}', t) for (phase, t) in report["phases"].items()],
+    )
+    for name, value in report["counts"].items():
+        AddMetric(
+            name,
+            f"Number of {name.replace('_', ' ')} in the last download",
+            [("", value)],
+        )
+    quantiles = {"p50": "0.5", "p90": "0.9", "p99": "0.99", "max": "1"}
+    for name in ("route_seconds", "download_seconds"):
+        AddMetric(
+            name,
+            f"Quantiles of the {name.replace('_', ' ')} in the last download",
+            [(f'{{quantile="{quantiles[k]}"}}', v) for (k, v) in report[name].items()],
+        )
+
+    # Written under another name first, so the collector never reads half a file
+    with open(f"{location}.tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{location}.tmp", location)
+
+
+# Importing this file (like the benchmark does) only sets everything up
+if __name__ == "__main__":
+    if args.rollback:
+        Rollback()
+        exit(0)
+
+    start_stopwatch = perf_counter()
+    print(
+        f"Starting the scraping at {datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S %Z%z')}"
+    )
+    generation = SetupGeneration()
+    SetupOfflineArchive(generation)
+    with Measure("setup_update"):
+        SetupUpdate()
+    print("Downloaded all modification dates. Now downloading the pages.")
+    with Measure("download_everything"):
+        DownloadEverything()
+    printdev("Finished downloading all pages. Now cleaning up")
+    with Measure("cleanup_update"):
+        CleanupUpdate(generation)
+    seconds = perf_counter() - start_stopwatch
+    print(
+        f"Finished downloading {numdownloaded} files ({numnotmodified} not modified) in {int(seconds)} seconds"
+    )
+    report = GetReport(seconds)
+    if args.report:
+        WriteReport(args.report, report)
+    if args.prometheus_textfile:
+        WritePrometheus(args.prometheus_textfile, report)
 
-printdev(f"Removed rel types: {removedRelTypes}")
+    printdev(f"Removed rel types: {removedRelTypes}")
@@ -2,11 +2,8 @@
 
 set -e
 
-find ./static -maxdepth 20 -type f -name "*.css" -delete
-find ./static -maxdepth 20 -type f -name "*.html" -delete
-find ./static -maxdepth 20 -type f -name "*.js" -delete
-
-python cache.py
+# The files are rewritten in a new generation, the one that is served stays complete until that is done
+python cache.py --regenerate html,css,js
 
 git add .
 git commit -m "Regenerate all html and css files"
@@ -0,0 +1,67 @@
+#!/bin/sh
+# Usage: sync_changes.sh SOURCE DESTINATION [RCLONE FLAGS...]
+#
+# Only uploads the files that cache.py lists in SOURCE/.changes.json, if DESTINATION got the generation that the
+# download was compared against the previous time. Otherwise (or without jq) everything is synced with --checksum.
+# The id of the generation DESTINATION has is kept next to it (not in it, so it isn't served) as DESTINATION.synced-generation,
+# so it is known on every machine that syncs, like a new CI runner.
+# Files matching the extended regex in $SKIP are never uploaded, rclone ignores its filter flags with --files-from.
+# If $INVALIDATIONS is set, the paths to invalidate in the CDN are written to that file, one per line.
+
+set -e
+
+source="${1%/}"
+destination="$2"
+shift 2
+
+changes="$source/.changes.json"
+state="${destination%/}.synced-generation"
+list="$(mktemp)"
+trap 'rm -f "$list"' EXIT
+
+generation=""
+previous=""
+if command -v jq >/dev/null && test -f "$changes"
+then
+    generation="$(jq -r '.id // empty' "$changes")"
+    previous="$(jq -r '.previous_id // empty' "$changes")"
+fi
+
+synced="$(rclone cat "$state" 2>/dev/null || true)"
+if test -n "$generation" && test "$synced" = "$generation"
+then
+    echo "$destination already has generation $generation"
+    if test -n "$INVALIDATIONS"
+    then
+        : > "$INVALIDATIONS"
+    fi
+elif test -n "$previous" && test "$synced" = "$previous"
+then
+    echo "Uploading the changes from generation $previous to $generation"
+    jq -r '.added[], .changed[]' "$changes" | grep -v -E "${SKIP:-^$}" > "$list" || true
+    if test -s "$list"
+    then
+        rclone copy "$source/" "$destination" --files-from-raw "$list" --no-traverse -v
+    fi
+    jq -r '.removed[]' "$changes" | grep -v -E "${SKIP:-^$}" > "$list" || true
+    if test -s "$list"
+    then
+        rclone delete "$destination" --files-from-raw "$list" -v
+    fi
+    if test -n "$INVALIDATIONS"
+    then
+        jq -r '.invalidate[]' "$changes" > "$INVALIDATIONS"
+    fi
+else
+    echo "Don't know what $destination has, syncing everything"
+    rclone sync "$source/" "$destination" --checksum -v "$@"
+    if test -n "$INVALIDATIONS"
+    then
+        echo "/*" > "$INVALIDATIONS"
+    fi
+fi
+
+if test -n "$generation"
+then
+    echo "$generation" | rclone rcat "$state"
+fi
@@ -1,11 +1,9 @@
 #!/bin/sh
 set -e
 
-find static/ -maxdepth 50 -type f -name "*.time" -delete
-find static/ -maxdepth 50 -type f -name "*.query" -delete
-
 rclone config create sib-utrecht s3 provider=AWS region=eu-central-1 location_constraint=eu-central-1 storage_class=INTELLIGENT_TIERING env_auth=true
-rclone sync static \
-    sib-utrecht:sib-utrecht-www1/sib-utrecht-www/live --checksum -v
-
+SKIP="\.(html|css|js|svg|json|txt|xml)\.(gz|br)$" "$(dirname "$0")/sync_changes.sh" static/ \
+    sib-utrecht:sib-utrecht-www1/sib-utrecht-www/live \
+    --exclude /.manifest.jsonl --exclude /.modification-times.json --exclude /.changes.json \
+    --exclude "*.{html,css,js,svg,json,txt,xml}.{gz,br}"
 
@@ -6,5 +6,7 @@
 
 set -e
 
-aws-vault exec vincent-laptop2-nixos-sib --no-session -- rclone sync static \
-    sib-aws:sib-utrecht-www1/sib-utrecht-www/live --checksum -v
+SKIP="\.(html|css|js|svg|json|txt|xml)\.(gz|br)$" aws-vault exec vincent-laptop2-nixos-sib --no-session -- \
+    "$(dirname "$0")/sync_changes.sh" static/ sib-aws:sib-utrecht-www1/sib-utrecht-www/live \
+    --exclude /.manifest.jsonl --exclude /.modification-times.json --exclude /.changes.json \
+    --exclude "*.{html,css,js,svg,json,txt,xml}.{gz,br}"
@@ -1,3 +1,4 @@
 #!/bin/sh
 
-rclone sync data/static /home/fedora/edit-sib-utrecht-nl/data/www/html -v --checksum
+"$(dirname "$0")/sync_changes.sh" data/static/ /home/fedora/edit-sib-utrecht-nl/data/www/html \
+    --exclude /.manifest.jsonl --exclude /.modification-times.json --exclude /.changes.json
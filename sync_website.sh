@@ -12,7 +12,31 @@ echo ""
 
 set -e
 cd data/
-python ../cache.py
+
+# Requests to the build trigger can say which pages changed with ?changed=<url>, then only those pages (and the pages
+# that link to them) are downloaded again. The part of the log that was handled already is skipped
+TRIGGER_LOG=/home/fedora/edit-sib-utrecht-nl/data/nginx/log/trigger_build_access.log
+changed=""
+offset=0
+if test -f "$TRIGGER_LOG"
+then
+    offset=$(stat -c %s "$TRIGGER_LOG")
+    handled=$(cat trigger-offset 2>/dev/null || echo 0)
+    if test "$offset" -lt "$handled"
+    then
+        # The log was rotated
+        handled=0
+    fi
+    tail -c +$((handled + 1)) "$TRIGGER_LOG" | head -c $((offset - handled)) > trigger-new.log
+    # Only if every new request names its page, otherwise it is a request to update everything
+    if test -s trigger-new.log && ! grep -v -q "[?&]changed=" trigger-new.log
+    then
+        changed="--changed-file trigger-new.log"
+    fi
+fi
+
+python ../cache.py --concurrency 8 --precompress --report cache-report.json $changed
+echo "$offset" > trigger-offset
 
 cd ../
 ./sync_static_server.sh